@@ -6,52 +6,437 @@ Date:           02-12-2020
 Description:    This script generates an txt file with measures
                 using the (filled) sqlite database from 'api.py'.
 
+                With --incremental the counts are kept in a state file
+                (--state) together with the id of the last vote that is
+                counted. The next run only reads the votes after that id
+                from the votes table of 'api.py', so the measures can be
+                refreshed often during a campaign. The measures are
+                written as JSON (--json).
+
 Usage:          python analysis.py <path_to_database>
+                    [--incremental] [--state <path>] [--json <path>]
 '''
 
+import argparse
+import json
+import os
 import sqlite3
 import sys
+import warnings
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
-from sklearn.metrics import cohen_kappa_score
 
 
-def split_items(items):
+def kappa(tables):
     '''
-    Not the prettiest, but we need to transform counts to labels:
-        - 0 means both chose *the other label*
-        - 1 means both chose another label
-        - 2 means both chose *this* label
-
-    Since it is Cohens Kappa, the labels do not matter, but when
-    provided with the 'with' list, this generates the correct labels
-    for all double annotations.
+    Cohens Kappa of one or more contingency tables. The last axis holds
+    the number of double annotated items with 0, 1 and 2 times 'with'.
+    Since it is Cohens Kappa, the labels do not matter, so the first
+    annotator is said to choose 'with' for 1 and 2 and the second only
+    for 2. Returns nan where kappa is not defined.
     '''
-    x, y = [], []
+    tables = np.asarray(tables, dtype=float)
+    total = tables.sum(axis=-1)
 
-    for i in items:
-        if i == 0:
-            x.append('without')
-            y.append('without')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        observed = (tables[..., 0] + tables[..., 2]) / total
+        with_a = (tables[..., 1] + tables[..., 2]) / total
+        with_b = tables[..., 2] / total
+        expected = with_a * with_b + (1 - with_a) * (1 - with_b)
+        result = (observed - expected) / (1 - expected)
 
-        if i == 1:
-            x.append('with')
-            y.append('without')
+    return np.where(expected < 1, result, np.nan)
 
-        if i == 2:
-            x.append('with')
-            y.append('with')
 
-    return x, y
+def optional(x):
+    ''' Converts a numpy float to a float or None for nan (for output) '''
+    return None if np.isnan(x) else float(x)
 
 
-def main():
+def kappa_from_counts(n0, n1, n2):
+    ''' Same as kappa for a single table, returns None if not defined '''
+    return optional(kappa([n0, n1, n2]))
+
+
+def contingency_tables(with_counts, strata, n_strata):
+    '''
+    Counts the 0, 1 and 2 times 'with' per stratum with a single
+    bincount. <strata> has the stratum of every count, items with more
+    than 2 times 'with' are skipped. Returns an array of (n_strata, 3).
+    '''
+    valid = with_counts <= 2
+    codes = strata[valid] * 3 + with_counts[valid]
+
+    return np.bincount(codes, minlength=n_strata * 3).reshape(n_strata, 3)
+
+
+def bootstrap_kappa(tables, n_samples=1000, confidence=0.95, seed=0):
+    '''
+    Bootstrap confidence interval of the kappa of every table. Resampling
+    the items of a table is the same as drawing a new table from a
+    multinomial distribution. Returns arrays with the low and high ends.
+    '''
+    tables = np.atleast_2d(tables)
+    totals = tables.sum(axis=1)
+    rng = np.random.default_rng(seed)
+
+    samples = np.stack([
+        rng.multinomial(total, table / total, size=n_samples)
+        if total > 0 else np.zeros((n_samples, 3), dtype=int)
+        for table, total in zip(tables, totals)
+    ], axis=1)
+
+    kappas = kappa(samples)
+    alpha = (1 - confidence) / 2 * 100
+
+    # Samples where kappa is not defined are skipped, a table without
+    # any defined sample simply gets nan.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        low, high = np.nanpercentile(kappas, [alpha, 100 - alpha], axis=0)
+
+    return low, high
+
+
+def score_labels(edges):
+    ''' Names of the score buckets that np.digitize gives for <edges> '''
+    bounds = [None] + list(edges) + [None]
+
+    return [
+        f'score < {high}' if low is None else
+        f'score >= {low}' if high is None else
+        f'{low} <= score < {high}'
+        for low, high in zip(bounds, bounds[1:])
+    ]
+
+
+def kappa_per_stratum(df, edges, n_samples, confidence, seed):
+    '''
+    Returns a dict with the contingency table, kappa and confidence
+    interval of all double annotated items, per system choice and per
+    score bucket. All strata are counted at once.
+    '''
+    double = df[df.total_validations > 1]
+    with_counts = double.total_with_explanation.to_numpy(dtype=int)
+
+    choices, choice_index = np.unique(
+        double.system_choice.to_numpy(dtype=str),
+        return_inverse=True
+    )
+    buckets = np.digitize(double.score.to_numpy(dtype=float), edges)
+
+    names = ['all'] + list(choices) + score_labels(edges)
+    strata = np.concatenate([
+        np.zeros(len(with_counts), dtype=int),
+        1 + choice_index,
+        1 + len(choices) + buckets,
+    ])
+
+    tables = contingency_tables(np.tile(with_counts, 3), strata, len(names))
+    kappas = kappa(tables)
+    low, high = bootstrap_kappa(tables, n_samples, confidence, seed)
+
+    return {
+        name: {
+            'table': [int(x) for x in table],
+            'kappa': optional(k),
+            'ci': [optional(lo), optional(hi)],
+        }
+        for name, table, k, lo, hi in zip(names, tables, kappas, low, high)
+    }
+
+
+def ratio(a, b):
+    return a / b if b != 0 else None
+
+
+def empty_state(database_path):
+    return {
+        'database': str(database_path),
+        'last_vote_id': 0,
+        # id: [system decision, system choice, with, without]
+        'items': {},
+        # 'decision/choice': number of items and votes
+        'counts': {},
+        # Double annotated items with 0, 1 or 2 times 'with'
+        'agreement': [0, 0, 0],
+    }
+
+
+def apply_item(state, item, sign):
+    ''' Adds (sign 1) or removes (sign -1) an item from the counts '''
+    decision, choice, n_with, n_without = item
+    counts = state['counts'].setdefault(
+        f'{decision}/{choice}',
+        {'items': 0, 'with': 0, 'without': 0}
+    )
+
+    if n_with + n_without > 0:
+        counts['items'] += sign
+
+    counts['with'] += sign * n_with
+    counts['without'] += sign * n_without
+
+    # Same as the full analysis, items with more than two validations
+    # only count if they have at most two times 'with'.
+    if n_with + n_without > 1 and n_with <= 2:
+        state['agreement'][n_with] += sign
+
+
+def load_state(state_path, database_path):
+    if not os.path.isfile(state_path):
+        return None
+
+    with open(state_path, 'r', encoding='utf8') as f:
+        state = json.load(f)
+
+    # A state of another database is useless
+    if state['database'] != str(database_path):
+        return None
+
+    return state
+
+
+def save_json(path, data):
+    # Replacing the file makes sure a reader never sees half a file
+    with open(f'{path}.tmp', 'w', encoding='utf8') as f:
+        json.dump(data, f, indent=4)
+
+    os.replace(f'{path}.tmp', path)
+
+
+def update_state(connection, state):
+    '''
+    Adds the votes after the last counted vote to the state. The first
+    time all counts are read from the validation table instead. Both
+    happen in one read transaction, so no vote is missed or counted twice.
+    '''
+    connection.execute('BEGIN')
+
     try:
-        database_path = sys.argv[1]
-    except ValueError:
-        print(__doc__)
-        exit()
+        if state['last_vote_id'] == 0 and len(state['items']) == 0:
+            rows = connection.execute(
+                "SELECT id, system_decision, system_choice, \
+                total_with_explanation, total_without_explanation \
+                FROM validation_model WHERE total_validations != 0"
+            )
+
+            for row in rows:
+                item = list(row[1:])
+                state['items'][str(row[0])] = item
+                apply_item(state, item, 1)
+
+            state['last_vote_id'] = connection.execute(
+                "SELECT coalesce(max(id), 0) FROM validation_vote"
+            ).fetchone()[0]
+
+            return 0
+
+        votes = connection.execute(
+            "SELECT v.id, v.validation_id, v.choice, \
+            m.system_decision, m.system_choice \
+            FROM validation_vote v \
+            JOIN validation_model m ON m.id = v.validation_id \
+            WHERE v.id > ? ORDER BY v.id",
+            (state['last_vote_id'],)
+        ).fetchall()
+
+        for vote_id, validation_id, choice, decision, system_choice in votes:
+            item = state['items'].get(str(validation_id))
+
+            if item is None:
+                item = [decision, system_choice, 0, 0]
+            else:
+                apply_item(state, item, -1)
+
+            item[2 if choice == 'with' else 3] += 1
+
+            apply_item(state, item, 1)
+            state['items'][str(validation_id)] = item
+            state['last_vote_id'] = vote_id
+
+        return len(votes)
+    finally:
+        connection.execute('COMMIT')
+
+
+def measures_from_state(state, n_samples=1000, confidence=0.95, seed=0):
+    ''' Returns the same measures as the full analysis as a dict '''
+    def total(key, decision=None, choice=None):
+        return sum(
+            counts[key] for name, counts in state['counts'].items()
+            if decision in (None, name.split('/')[0])
+            and choice in (None, name.split('/', 1)[1])
+        )
+
+    total_with = total('items', 'with')
+    total_without = total('items', 'without')
+    total_context_with = total('items', 'with', 'CONTEXT')
+    total_context_without = total('items', 'without', 'CONTEXT')
+    total_knowledge_with = total('items', 'with', 'COMMON_KNOWLEDGE')
+    total_knowledge_without = total('items', 'without', 'COMMON_KNOWLEDGE')
+
+    total_ann_with_a = total('with', 'with')
+    total_ann_without_a = total('without', 'without')
+    total_ann_with_c = total('with', 'with', 'CONTEXT')
+    total_ann_without_c = total('without', 'without', 'CONTEXT')
+    total_ann_with_k = total('with', 'with', 'COMMON_KNOWLEDGE')
+    total_ann_without_k = total('without', 'without', 'COMMON_KNOWLEDGE')
+
+    return {
+        'database_used': state['database'],
+        'created_measures_at': datetime.now().strftime("%Y-%m-%d_%H-%M-%S"),
+        'last_vote_id': state['last_vote_id'],
+        'system_counts': {
+            'total_sentences': total('items'),
+            'total_with': total_with,
+            'total_without': total_without,
+            'total_context_with': total_context_with,
+            'total_context_without': total_context_without,
+            'total_knowledge_with': total_knowledge_with,
+            'total_knowledge_without': total_knowledge_without,
+        },
+        'annotation_counts': {
+            'total_annotations': total('with') + total('without'),
+            'total_ann_with': total('with'),
+            'total_ann_without': total('without'),
+            'total_ann_with_a': total_ann_with_a,
+            'total_ann_without_a': total_ann_without_a,
+            'total_ann_with_c': total_ann_with_c,
+            'total_ann_without_c': total_ann_without_c,
+            'total_ann_with_k': total_ann_with_k,
+            'total_ann_without_k': total_ann_without_k,
+        },
+        'percentage_agree_all': {
+            'per_with_agree_a': ratio(total_ann_with_a, total_with),
+            'per_without_agree_a': ratio(total_ann_without_a, total_without),
+        },
+        'percentage_agree_context': {
+            'per_with_agree_c': ratio(total_ann_with_c, total_context_with),
+            'per_without_agree_c': ratio(
+                total_ann_without_c,
+                total_context_without
+            ),
+        },
+        'percentage_agree_knowledge': {
+            'per_with_agree_k': ratio(total_ann_with_k, total_knowledge_with),
+            'per_without_agree_k': ratio(
+                total_ann_without_k,
+                total_knowledge_without
+            ),
+        },
+        'contingency': state['agreement'],
+        'cohens_kappa': kappa_from_counts(*state['agreement']),
+        'cohens_kappa_ci': [
+            optional(x[0]) for x in bootstrap_kappa(
+                state['agreement'],
+                n_samples,
+                confidence,
+                seed
+            )
+        ],
+    }
+
+
+def run_incremental(database_path, state_path, json_path, args):
+    state = load_state(state_path, database_path) or \
+        empty_state(database_path)
+
+    # Transactions are started by hand, see 'update_state'
+    connection = sqlite3.connect(database_path, isolation_level=None)
+
+    has_votes = connection.execute(
+        "SELECT count(*) FROM sqlite_master \
+        WHERE type = 'table' AND name = 'validation_vote'"
+    ).fetchone()[0]
+
+    if not has_votes:
+        connection.close()
+        print('The database has no votes table, use the full analysis')
+        return
+
+    new_votes = update_state(connection, state)
+    connection.close()
+
+    save_json(state_path, state)
+
+    measures = measures_from_state(
+        state,
+        args.bootstrap,
+        args.confidence,
+        args.seed
+    )
+    save_json(json_path, measures)
+
+    print(
+        f'Counted {new_votes} new votes (up to vote \
+        {state["last_vote_id"]}), Cohens Kappa {measures["cohens_kappa"]}'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "database_path",
+        help="Path to the sqlite database of the api"
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        help="Only count the new votes since the last run",
+        action="store_true"
+    )
+    parser.add_argument(
+        "-s",
+        "--state",
+        default='analysis_state.json',
+        help="State file used with --incremental, default is \
+              analysis_state.json"
+    )
+    parser.add_argument(
+        "-j",
+        "--json",
+        default='measures_latest.json',
+        help="JSON file with the measures of --incremental, default is \
+              measures_latest.json"
+    )
+    parser.add_argument(
+        "-b",
+        "--bootstrap",
+        type=int,
+        default=1000,
+        help="Number of bootstrap samples for the confidence interval of \
+              kappa, default is 1000"
+    )
+    parser.add_argument(
+        "-c",
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="Confidence level of the interval, default is 0.95"
+    )
+    parser.add_argument(
+        "--score-bins",
+        type=float,
+        nargs="+",
+        default=[0.25, 0.5, 0.75],
+        help="Edges of the score buckets for kappa per bucket, default \
+              is 0.25 0.5 0.75"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the bootstrap samples, default is 0"
+    )
+    args = parser.parse_args()
+    database_path = args.database_path
+
+    if args.incremental:
+        run_incremental(database_path, args.state, args.json, args)
+        return
 
     connection = sqlite3.connect(database_path)
     df = pd.read_sql_query(
@@ -98,11 +483,17 @@ def main():
     per_with_agree_k = total_ann_with_k / total_knowledge_with
     per_without_agree_k = total_ann_without_k / total_knowledge_without
 
-    all_double_with = list(
-        df[df.total_validations > 1].total_with_explanation
+    strata = kappa_per_stratum(
+        df,
+        args.score_bins,
+        args.bootstrap,
+        args.confidence,
+        args.seed
+    )
+    strata_output = ''.join(
+        f"\n        '{name}': {stratum},"
+        for name, stratum in strata.items()
     )
-
-    a, b = split_items(all_double_with)
 
     date = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
@@ -142,7 +533,10 @@ def main():
         'per_with_agree_k': {per_with_agree_k},
         'per_without_agree_k': {per_without_agree_k},
     }},
-    'cohens_kappa': {cohen_kappa_score(a, b)}
+    'cohens_kappa': {strata['all']['kappa']},
+    'cohens_kappa_ci': {strata['all']['ci']},
+    'cohens_kappa_per_stratum': {{{strata_output}
+    }}
 }}
     '''
 
@@ -0,0 +1,228 @@
+import json
+import os
+import pickle
+import sqlite3
+from collections import OrderedDict
+
+
+class PickleExplanationCache(dict):
+    '''
+    The original cache: a plain dict that is pickled as a whole. Every
+    insert rewrites the entire file, so this is only useful for small
+    caches or for reading an old cache file.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+        if not os.path.isfile(path):
+            with open(path, 'wb') as o:
+                pickle.dump({}, o)
+
+        with open(path, 'rb') as f:
+            super().__init__(pickle.load(f))
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+
+        with open(self.path, 'wb') as o:
+            pickle.dump(dict(self), o)
+
+    def close(self):
+        pass
+
+
+class SqliteExplanationCache():
+    '''
+    Keyed store for the Wikipedia summaries backed by sqlite. Inserts only
+    write the new row (no full rewrite) and reads only fetch the requested
+    key, so the cache never has to be loaded in memory as a whole. Every
+    insert is committed right away, with WAL enabled this is cheap and
+    nothing is lost when the process crashes.
+
+    The 'meta' table records whether the old pickled cache was migrated,
+    this is set in the same transaction as the migrated rows.
+    '''
+
+    MIGRATED = 'pickle_migrated'
+
+    def __init__(self, path):
+        self.path = path
+
+        # The timeout helps when multiple processes share the same file
+        self.connection = sqlite3.connect(str(path), timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS explanation ('
+            'title TEXT PRIMARY KEY, data TEXT NOT NULL)'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS meta ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL)'
+        )
+        self.connection.commit()
+
+    def __contains__(self, key):
+        return self.connection.execute(
+            'SELECT 1 FROM explanation WHERE title = ?', (key,)
+        ).fetchone() is not None
+
+    def __getitem__(self, key):
+        row = self.connection.execute(
+            'SELECT data FROM explanation WHERE title = ?', (key,)
+        ).fetchone()
+
+        if row is None:
+            raise KeyError(key)
+
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO explanation (title, data) '
+                'VALUES (?, ?)',
+                (key, json.dumps(value))
+            )
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM explanation'
+        ).fetchone()[0]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, items):
+        ''' Inserts a lot of items in a single transaction '''
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO explanation (title, data) '
+                'VALUES (?, ?)',
+                ((k, json.dumps(v)) for k, v in items.items())
+            )
+
+    def is_migrated(self):
+        return self.connection.execute(
+            'SELECT 1 FROM meta WHERE key = ?', (self.MIGRATED,)
+        ).fetchone() is not None
+
+    def migrate(self, items):
+        '''
+        Inserts the items of the old cache and marks the migration as done
+        in a single transaction, so a migration that is interrupted is
+        done again next time. Entries that are already in the cache are
+        newer, so those are kept.
+        '''
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO explanation (title, data) '
+                'VALUES (?, ?)',
+                ((k, json.dumps(v)) for k, v in items.items())
+            )
+            self.connection.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                (self.MIGRATED, '1')
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+CACHE_BACKENDS = {
+    'pickle': PickleExplanationCache,
+    'sqlite': SqliteExplanationCache,
+}
+
+
+def migrate_pickle_cache(pickle_path, cache):
+    '''
+    Copies all entries of an old pickled explanation cache into the given
+    sqlite cache. Returns the number of entries in the old cache.
+    '''
+    with open(pickle_path, 'rb') as f:
+        old_cache = pickle.load(f)
+
+    cache.migrate(old_cache)
+
+    return len(old_cache)
+
+
+class EmbeddingCache():
+    '''
+    Cache for everything that is needed from a Wikipedia summary when
+    scoring an entity: the first sentence of the extract, the description
+    and their cleaned mean vectors. The most recently used entries are
+    kept in memory, all entries are stored in a sqlite table (next to the
+    explanations). Vectors depend on the spacy model, so entries made with
+    another model are ignored.
+    '''
+
+    def __init__(self, path, model, max_size=50000):
+        self.model = model
+        self.max_size = max_size
+        self.memory = OrderedDict()
+
+        self.connection = sqlite3.connect(str(path), timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS embedding ('
+            'title TEXT PRIMARY KEY, model TEXT NOT NULL, data BLOB NOT NULL)'
+        )
+        self.connection.commit()
+
+    def get_many(self, titles):
+        ''' Returns a dictionary with the entries that were found '''
+        found = {}
+        missing = []
+
+        for title in titles:
+            if title in self.memory:
+                self.memory.move_to_end(title)
+                found[title] = self.memory[title]
+            else:
+                missing.append(title)
+
+        # Sqlite has a limit on the amount of variables in a query
+        for i in range(0, len(missing), 500):
+            part = missing[i:i + 500]
+            rows = self.connection.execute(
+                'SELECT title, data FROM embedding WHERE model = ? '
+                f'AND title IN ({",".join("?" * len(part))})',
+                [self.model, *part]
+            )
+
+            for title, data in rows:
+                found[title] = pickle.loads(data)
+                self.__remember(title, found[title])
+
+        return found
+
+    def update(self, entries):
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO embedding (title, model, data) '
+                'VALUES (?, ?, ?)',
+                (
+                    (title, self.model, pickle.dumps(entry))
+                    for title, entry in entries.items()
+                )
+            )
+
+        for title, entry in entries.items():
+            self.__remember(title, entry)
+
+    def close(self):
+        self.connection.close()
+
+    def __remember(self, title, entry):
+        self.memory[title] = entry
+        self.memory.move_to_end(title)
+
+        if len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
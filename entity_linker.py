@@ -1,10 +1,12 @@
 import json
 import os
-import pickle
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import requests
 import spacy
-import spotlight
 
 from support.config import Config
 from utils import *
@@ -41,6 +43,8 @@ class EntityLinker:
         url=Config.SPOTLIGHT_API_URL,  # Default local url
         types=['DBpedia:Name', 'DBpedia:Organisation',
                'DBpedia:Person', 'DBpedia:Place'],  # Best for named entities
+        wiki_workers=Config.WIKI_MAX_WORKERS,  # Concurrent wiki requests
+        spotlight_workers=Config.SPOTLIGHT_MAX_WORKERS,  # Requests in flight
     ):
         self.verbose = verbose
         self.verbose and print(
@@ -50,6 +54,7 @@ class EntityLinker:
         # --- Spotlight settings ---
         self.url = url
         self.types = ','.join(types)
+        self.spotlight_workers = spotlight_workers
 
         # --- Text processing ---
         self.stop_words = load_stop_words()
@@ -65,8 +70,23 @@ class EntityLinker:
         # There are a lot of entities that occur multiple times in the texts
         # because of this and because we don't want to 'abuse' the wikipedia
         # api, we chache the responses. It is also considerably faster!
+        # See 'cache.py' for the available backends.
         self.explanation_cache = load_or_create_expl_cache()
 
+        # The same goes for parsing the explanations, popular entities
+        # only need to be parsed and vectorized once.
+        self.embedding_cache = load_embedding_cache()
+
+        # --- Wikipedia settings ---
+        self.wiki_workers = wiki_workers
+
+        # One session for all requests (Spotlight and Wikipedia), this
+        # reuses the connections instead of doing a new handshake for
+        # every request. Every host gets its own pool of connections.
+        self.session = create_http_session(
+            pool_size=max(wiki_workers, spotlight_workers)
+        )
+
         # Highlight tags for the explanation used in validation
         self.h_start = '<span class="annotation">'
         self.h_end = '</span>'
@@ -85,75 +105,202 @@ class EntityLinker:
                     <surface form entity>: {
                         'dbpedia': <spotlight annotation json response>,
                         'wikipedia': <wikipedia api summary json response>,
+                        'title': <wikipedia title>,
                     }
                 }
                 'status': <EntityLinkerStatus>,
             }
         '''
-        response = {
-            'entities': {},
-            'status': EntityLinkerStatus.NO_ENTITIES,
+        return self.find_many([text], confidence)[0]
+
+    def find_many(self, texts, confidence=0.4):
+        '''
+        Same as 'find', but for a batch of texts. The texts are sent to
+        Spotlight in parallel and all Wikipedia summaries that are not
+        cached yet are fetched concurrently for the whole batch. Returns
+        a list of responses in the same order as the texts.
+        '''
+        with ThreadPoolExecutor(max_workers=self.spotlight_workers) as ex:
+            linked = list(ex.map(
+                lambda text: self.__spotlight_annotate(text, confidence),
+                texts
+            ))
+
+        return self.__resolve_many(linked)
+
+    def find_iter(self, texts, confidence=0.4):
+        '''
+        Generator version of 'find' for a (possibly very long) iterable of
+        texts. It keeps up to 'spotlight_workers' Spotlight requests in
+        flight, so Spotlight keeps working while the caller processes
+        (annotates) the previous results. Yields (text, response) tuples
+        in the same order as the texts.
+        '''
+        with ThreadPoolExecutor(max_workers=self.spotlight_workers) as ex:
+            pending = deque()
+
+            for text in texts:
+                pending.append((
+                    text,
+                    ex.submit(self.__spotlight_annotate, text, confidence)
+                ))
+
+                if len(pending) > self.spotlight_workers:
+                    text, future = pending.popleft()
+                    yield text, self.__resolve_many([future.result()])[0]
+
+            while pending:
+                text, future = pending.popleft()
+                yield text, self.__resolve_many([future.result()])[0]
+
+    def __resolve_many(self, linked):
+        '''
+        Adds the Wikipedia info to a list of Spotlight results,
+        see '__spotlight_annotate'.
+        '''
+        missing = {
+            wiki_title
+            for entities in linked if entities is not None
+            for wiki_title, _ in entities
+            if wiki_title not in self.explanation_cache
         }
 
+        fetched = self.__fetch_wiki_summaries(missing)
+
+        return [self.__build_response(e, fetched) for e in linked]
+
+    def __spotlight_annotate(self, text, confidence):
+        '''
+        Returns a list of (wiki title, spotlight annotation) tuples
+        for every unique entity found in the text or None if Spotlight
+        did not find anything. This is called from multiple threads
+        at the same time, so it should only read shared state.
+        '''
         try:
-            # This small wrapper library cleans the json keys we
-            # get back from spotlight, but it also throws an exception
-            # when no entities are found
-            result = spotlight.annotate(
+            response = self.session.post(
                 self.url,
-                text,
-                filters={
+                data={
+                    'text': text,
                     # The default confidence might seem low, but Spotlight
                     # is pretty strict with high confidences and there were
                     # not that many errors.
                     'confidence': confidence,
                     'types': self.types,
-                }
+                },
+                headers={'Accept': 'application/json'},
+                timeout=Config.HTTP_TIMEOUT,
             )
-        except (spotlight.SpotlightException, requests.exceptions.HTTPError):
-            return response
+            response.raise_for_status()
+            result = response.json()
+        except (
+            requests.exceptions.HTTPError,
+            requests.exceptions.RetryError,
+            ValueError,
+        ):
+            # Only this document is skipped. Connection errors and timeouts
+            # are not caught: when Spotlight is down we want to stop instead
+            # of going through the rest of the corpus without entities.
+            return None
+
+        # Spotlight leaves out the resources when no entities are found
+        if 'Resources' not in result:
+            return None
 
         seen = set()
+        entities = []
 
-        for entity_data in result:
-            try:
-                link = self.wiki_lookup[f'<{entity_data["URI"]}>']
+        for resource in result['Resources']:
+            entity_data = clean_spotlight_resource(resource)
 
-                # We only want to find information about an entity once
-                if link in seen:
-                    continue
+            wiki_title = self.wiki_lookup.get(
+                resource_name(entity_data['URI'])
+            )
 
-                seen.add(link)
-            except KeyError:
+            # We only want to find information about an entity once
+            if wiki_title is None or wiki_title in seen:
                 continue
 
-            wiki_title = extract_wiki_title(link)
+            seen.add(wiki_title)
 
-            if wiki_title in self.explanation_cache.keys():
-                wiki_data = self.explanation_cache[wiki_title]
+            entities.append((wiki_title, entity_data))
 
-                self.verbose and print(
-                    f'FROM CHACHE {wiki_title}', end='\r'
-                )
+        return entities
+
+    def __build_response(self, entities, fetched):
+        ''' Combines the Spotlight and Wikipedia info of a single text '''
+        response = {
+            'entities': {},
+            'status': EntityLinkerStatus.NO_ENTITIES,
+        }
+
+        if entities is None:
+            return response
+
+        for wiki_title, entity_data in entities:
+            if wiki_title in fetched:
+                wiki_data = fetched[wiki_title]
             else:
-                wiki_data = requests.get(
-                    f"{Config.WIKI_API_URL}{wiki_title}"
-                ).json()
+                wiki_data = self.explanation_cache.get(wiki_title)
 
                 self.verbose and print(
-                    f'FROM WIKI {wiki_title}', end='\r'
+                    f'FROM CHACHE {wiki_title}', end='\r'
                 )
 
-                self.explanation_cache[wiki_title] = wiki_data
-                self.__update_explanation_cache()
+            # Fetching this one failed, maybe next time
+            if wiki_data is None:
+                continue
 
             response['entities'][entity_data['surfaceForm']] = {
                 'dbpedia': entity_data,
                 'wikipedia': wiki_data,
+                'title': wiki_title,
             }
 
         return {**response, 'status': EntityLinkerStatus.OK}
 
+    def __fetch_wiki_summaries(self, wiki_titles):
+        '''
+        Gets the Wikipedia summaries for the given titles using a pool of
+        threads that share the (keep-alive) http session. Successful
+        responses are added to the explanation cache. Returns a dictionary
+        with the title as key and the summary or None as value.
+        '''
+        if len(wiki_titles) == 0:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=self.wiki_workers) as executor:
+            summaries = dict(zip(
+                wiki_titles,
+                executor.map(self.__fetch_wiki_summary, wiki_titles)
+            ))
+
+        # The cache is only written from this thread, sqlite connections
+        # can not be shared between threads.
+        for wiki_title, wiki_data in summaries.items():
+            if wiki_data is not None:
+                self.explanation_cache[wiki_title] = wiki_data
+
+        return summaries
+
+    def __fetch_wiki_summary(self, wiki_title):
+        ''' Gets a single summary, retries are handled by the session '''
+        try:
+            wiki_data = self.session.get(
+                f"{Config.WIKI_API_URL}{wiki_title}",
+                timeout=Config.HTTP_TIMEOUT,
+            ).json()
+        except (requests.exceptions.RequestException, ValueError):
+            self.verbose and print(
+                f'FAILED WIKI {wiki_title}', end='\r'
+            )
+            return None
+
+        self.verbose and print(
+            f'FROM WIKI {wiki_title}', end='\r'
+        )
+
+        return wiki_data
+
     def annotate(self, result, raw_text, threshold=0.5):
         '''
             Annotates the given text with all entities that get a score
@@ -179,6 +326,7 @@ class EntityLinker:
                     'extract': <raw fist sentence of extract used>,
                     'score': <score given for needed or not>,
                     'choice': <EntityLinkerChoice>,
+                    'offset': <character offset of the entity in the text>,
                     'context_with_explanation':
                         <sentence with entity,
                          possibly with surrounding context>,
@@ -192,66 +340,135 @@ class EntityLinker:
                 ...
             ]
         '''
-        doc_sents = list(self.nlp(raw_text).sents)
+        return self.annotate_many([result], [raw_text], threshold)[0]
+
+    def annotate_many(
+        self,
+        results,  # List of 'find' results
+        raw_texts,  # List of raw texts that belong to the results
+        threshold=0.5,
+        batch_size=Config.SPACY_BATCH_SIZE,
+        n_process=Config.SPACY_N_PROCESS,
+    ):
+        '''
+            Same as 'annotate', but for multiple texts at once. All texts
+            and the Wikipedia extracts and descriptions of their entities
+            are parsed together with 'nlp.pipe', which is a lot faster
+            than parsing every (small) text on its own. Extracts and
+            descriptions are only parsed the first time an entity is
+            seen, after that they come from the embedding cache.
+
+            Returns a list of 'annotate' results in the same order as the
+            given texts.
+        '''
+        wiki_data = {
+            entity_result['title']: entity_result['wikipedia']
+            for result in results
+            for entity_result in result['entities'].values()
+            if self.__has_explanation(entity_result['wikipedia'])
+        }
+
+        embeddings = self.embedding_cache.get_many(wiki_data.keys())
+        missing = [t for t in wiki_data.keys() if t not in embeddings]
+
+        wiki_texts = list({
+            text
+            for title in missing
+            for text in (wiki_data[title]['extract'],
+                         wiki_data[title]['description'])
+        })
+
+        docs = list(self.nlp.pipe(
+            list(raw_texts) + wiki_texts,
+            batch_size=batch_size,
+            n_process=n_process,
+        ))
+
+        wiki_docs = dict(zip(wiki_texts, docs[len(raw_texts):]))
+
+        new_embeddings = {
+            title: self.__embed_explanation(
+                wiki_docs[wiki_data[title]['extract']],
+                wiki_docs[wiki_data[title]['description']],
+            )
+            for title in missing
+        }
+        self.embedding_cache.update(new_embeddings)
+        embeddings.update(new_embeddings)
+
+        return [
+            self.__annotate_doc(result, raw_text, doc, embeddings, threshold)
+            for result, raw_text, doc in zip(results, raw_texts, docs)
+        ]
+
+    def __embed_explanation(self, extract_doc, explanation_doc):
+        '''
+            Creates the embedding cache entry of a Wikipedia summary. The
+            words are cleaned without removing the entity, because the
+            surface form differs per text, see 'get_is_needed_score'.
+        '''
+        # The first sentence of a Wikipedia article is the most direct
+        # explanation of the entity, so we use that one for similarity
+        extract = list(extract_doc.sents)[0]
+
+        return {
+            'extract': extract.text,
+            'explanation': explanation_doc.text,
+            'extract_clean': self.__clean_sentence(extract, None),
+            'explanation_clean': self.__clean_sentence(explanation_doc, None),
+        }
+
+    def __annotate_doc(self, result, raw_text, doc, embeddings, threshold):
+        '''
+            Annotates a single parsed text, 'embeddings' contains the
+            cached extracts and descriptions. See 'annotate' for the output.
+        '''
+        doc_sents = list(doc.sents)
+        sent_starts = [sent.start_char for sent in doc_sents]
 
         explanation_needed = []
         explanation_not_needed = []
 
-        annotated_text = raw_text
-        shift = 0
+        # The explanations are inserted in one go after all entities
+        # are scored, see 'insert_many'.
+        insertions = []
 
         for entity, entity_result in result['entities'].items():
-            # Wikipedia sometimes returns other stuff than listed in the
-            # api documentation, to go on with the rest we need to be sure
-            # the important fields are present.
-            if ('description' not in entity_result['wikipedia'].keys()
-                    or 'extract' not in entity_result['wikipedia'].keys()):
+            if not self.__has_explanation(entity_result['wikipedia']):
                 continue
 
-            # Sometimes the fields are present, but empty
-            if (len(entity_result['wikipedia']['description']) == 0
-                    or len(entity_result['wikipedia']['extract']) == 0):
-                continue
-
-            # The first sentence of a Wikipedia article is the most direct
-            # explanation of the entity, so we use that one for similarity
-            extract = list(
-                self.nlp(entity_result['wikipedia']['extract']).sents
-            )[0]
-            explanation = self.nlp(entity_result['wikipedia']['description'])
-            explanation_formatted = f" ({explanation.text})"
-
-            context_dict = self.__get_context(entity, doc_sents)
+            embedding = embeddings[entity_result['title']]
+            explanation_formatted = f" ({embedding['explanation']})"
 
-            context_with_explanation = insert(
-                context_dict['context_raw'],
-                explanation_formatted,
-                context_dict['context_raw'].find(entity) + len(entity)
+            context_dict = self.__get_context(
+                entity,
+                entity_result['dbpedia']['offset'],
+                raw_text,
+                doc_sents,
+                sent_starts
             )
 
-            # This is a bit hacky, but if we let the front end do it, we run
-            # into trouble when there are multiple brackets in the sentence.
-            # We could do some fancy regex or string manipulation, this is
-            # the most straightforward method.
-            context_highlighted = insert(
-                context_dict['context_raw'],
-                f' {self.h_start}{explanation_formatted.strip()}{self.h_end}',
-                context_dict['context_raw'].find(entity) + len(entity)
-            )
+            (context_with_explanation, context_highlighted) = \
+                self.__explain_context(
+                    context_dict['context_raw'],
+                    entity,
+                    explanation_formatted
+                )
 
             (score, choice) = self.get_is_needed_score(
                 entity,
                 context_dict,
-                extract,
-                explanation
+                embedding['extract_clean'],
+                embedding['explanation_clean']
             )
 
             full_entity_data = {
                 'entity': entity,
-                'explanation': explanation.text,
-                'extract': extract.text,
+                'explanation': embedding['explanation'],
+                'extract': embedding['extract'],
                 'score': score,
                 'choice': choice,
+                'offset': entity_result['dbpedia']['offset'],
                 'context_with_explanation': context_with_explanation,
                 'context_without_explanation': context_dict['context_raw'],
                 'context_highlighted': context_highlighted,
@@ -263,13 +480,11 @@ class EntityLinker:
 
             explanation_needed.append(full_entity_data)
 
-            # Account for previous entities and the current for
-            # the right position (just after the entity)
+            # The right position is just after the entity
             offset = entity_result['dbpedia']['offset']
-            annotated_text = insert(annotated_text, explanation_formatted,
-                                    (offset + shift + len(entity)))
+            insertions.append((offset + len(entity), explanation_formatted))
 
-            shift += len(explanation_formatted)
+        annotated_text = insert_many(raw_text, insertions)
 
         self.verbose and print(
             f"'\x1b[2K\r'Needed: {len(explanation_needed)} \
@@ -284,12 +499,45 @@ class EntityLinker:
             'ignored_entities': explanation_not_needed,
         }
 
+    def __explain_context(self, context_raw, entity, explanation_formatted):
+        '''
+            Inserts the explanation just after the entity in the context,
+            returns a tuple with the plain and the highlighted version.
+        '''
+        i = context_raw.find(entity) + len(entity)
+        head, tail = context_raw[:i], context_raw[i:]
+
+        # This is a bit hacky, but if we let the front end do it, we run
+        # into trouble when there are multiple brackets in the sentence.
+        # We could do some fancy regex or string manipulation, this is
+        # the most straightforward method.
+        highlighted = \
+            f'{self.h_start}{explanation_formatted.strip()}{self.h_end}'
+
+        return (
+            f'{head}{explanation_formatted}{tail}',
+            f'{head} {highlighted}{tail}',
+        )
+
+    def __has_explanation(self, wiki_data):
+        ''' Checks if the Wikipedia data can be used as explanation '''
+        # Wikipedia sometimes returns other stuff than listed in the
+        # api documentation, to go on with the rest we need to be sure
+        # the important fields are present.
+        if ('description' not in wiki_data.keys()
+                or 'extract' not in wiki_data.keys()):
+            return False
+
+        # Sometimes the fields are present, but empty
+        return (len(wiki_data['description']) != 0
+                and len(wiki_data['extract']) != 0)
+
     def get_is_needed_score(
         self,
         entity,  # Raw string of entity
         context,  # Dict with spacy spans of context info
-        extract,  # Raw string of first wiki extract sentence
-        explanation,  # Raw string of explanation
+        extract,  # Cleaned first wiki extract sentence (__clean_sentence)
+        explanation,  # Cleaned explanation (__clean_sentence)
         explanation_weight=0.7,
         extract_weight=0.3,
     ):
@@ -318,16 +566,16 @@ class EntityLinker:
             if len(context[context_type]) > 0
         ]
 
-        extract = self.__clean_sentence(extract, entity)
-        explanation = self.__clean_sentence(explanation, entity)
+        extract = self.__remove_entity(extract, entity)
+        explanation = self.__remove_entity(explanation, entity)
 
         explanation_sum = sum([
-            s.similarity(explanation)
-            for s in clean_sentences]) if len(explanation.text) > 0 else 0
+            self.__similarity(s, explanation)
+            for s in clean_sentences]) if len(explanation[0]) > 0 else 0
 
         extract_sum = sum([
-            s.similarity(extract)
-            for s in clean_sentences]) if len(extract.text) > 0 else 0
+            self.__similarity(s, extract)
+            for s in clean_sentences]) if len(extract[0]) > 0 else 0
 
         # In all the hundres of thousands of articles I never saw 0
         # clean sentences so a theoretical divide by zero should not happen.
@@ -345,36 +593,101 @@ class EntityLinker:
         return (score, EntityLinkerChoice.CONTEXT)
 
     def __clean_sentence(self, sentence, entity):
-        ''' Cleans stop words, unknown words and the entity itself '''
-        return self.nlp(
-            ' '.join([
-                w.text for w in sentence
-                if w.text.lower() not in self.stop_words
-                and w.text != entity
-                and w.has_vector
-            ])
+        '''
+            Cleans stop words, unknown words and the entity itself.
+            Returns a tuple with:
+                (words<tuple>, vector<numpy array>, norm<float>)
+
+            The vector is the mean of the word vectors, this is exactly
+            what spacy would give for a Doc of the cleaned words, but
+            without parsing the cleaned text again.
+        '''
+        words = [
+            w for w in sentence
+            if w.text.lower() not in self.stop_words
+            and w.text != entity
+            and w.has_vector
+        ]
+
+        return self.__vectorize(
+            [w.text for w in words],
+            [w.orth for w in words]
         )
 
-    def __get_context(self, entity, doc_sents):
+    def __remove_entity(self, clean, entity):
+        '''
+            Removes the entity from a sentence that was cleaned without
+            an entity, this gives the same as '__clean_sentence' with it.
+        '''
+        words = clean[0]
+
+        if entity not in words:
+            return clean
+
+        words = [w for w in words if w != entity]
+
+        return self.__vectorize(
+            words,
+            [self.nlp.vocab.strings[w] for w in words]
+        )
+
+    def __vectorize(self, words, keys):
+        ''' Mean vector and its norm of the given words (with vectors) '''
+        if len(words) == 0:
+            return ((), None, 0.0)
+
+        vectors = self.nlp.vocab.vectors
+        rows = vectors.find(keys=keys)
+        vector = vectors.data[rows].sum(axis=0) / len(words)
+
+        return (
+            tuple(words),
+            vector,
+            float(np.sqrt(np.dot(vector, vector))),
+        )
+
+    def __similarity(self, clean_a, clean_b):
+        '''
+            Cosine similarity of two cleaned sentences, this follows
+            spacy's 'Doc.similarity'.
+        '''
+        words_a, vector_a, norm_a = clean_a
+        words_b, vector_b, norm_b = clean_b
+
+        # Spacy says two docs with the same words are the same
+        if words_a == words_b:
+            return 1.0
+
+        if norm_a == 0 or norm_b == 0:
+            return 0.0
+
+        return float(np.dot(vector_a, vector_b) / (norm_a * norm_b))
+
+    def __get_context(self, entity, offset, raw_text, doc_sents, starts):
         '''
             Gets the context of a given entity in the text. In this case
-            that is 1 sentence left and one right if they exist.
-        '''
-        # We want to find the sentence the entity occurs in for the first time.
-        # This is a bit inefficient because we theoretically need to loop
-        # through all the sentences every time. However, we do not know where
-        # the entity is in the parsed sentences. Could be better, but this does
-        # ensure the entity is only evaluated the first time it is seen,
-        # which is what we want.
+            that is 1 sentence left and one right if they exist. 'starts'
+            contains the start (character) offset of every sentence.
+        '''
+        # We want to find the sentence the entity occurs in for the first
+        # time. Spotlight gives the offset of the first occurrence (we only
+        # keep the first annotation of every entity), so we can look up the
+        # sentence directly instead of looping through all of them. In case
+        # the offset does not match the text, we fall back to searching.
+        if not raw_text.startswith(entity, offset):
+            offset = raw_text.find(entity)
+
         sentence, left, right = '', '', ''
 
-        for i, sent in enumerate(doc_sents):
-            if entity in sent.text:
-                sentence = sent
-                left = '' if i == 0 else doc_sents[i - 1]
-                right = '' if i + 1 == len(doc_sents) \
-                    else doc_sents[i + 1]
-                break
+        i = bisect_right(starts, offset) - 1
+
+        # The entity can be split over multiple sentences when spacy makes
+        # a mistake with the sentence boundaries, this is skipped later on.
+        if offset != -1 and i >= 0 and entity in doc_sents[i].text:
+            sentence = doc_sents[i]
+            left = '' if i == 0 else doc_sents[i - 1]
+            right = '' if i + 1 == len(doc_sents) \
+                else doc_sents[i + 1]
 
         context_raw = f'{left} {sentence} {right}'.strip()
 
@@ -387,7 +700,7 @@ class EntityLinker:
 
     def __test_connection(self):
         ''' Checks if Spotlight is running '''
-        response = requests.get(self.url, params={'text': "test"})
+        response = self.session.get(self.url, params={'text': "test"})
 
         if response.status_code != 200:
             raise EntityLinkerException(
@@ -396,8 +709,3 @@ class EntityLinker:
             )
 
         self.verbose and print(f"Spotlight found at {self.url}")
-
-    def __update_explanation_cache(self):
-        ''' Updates the wiki explanations cache if needed '''
-        with open(Config.EXPLANATION_CACHE, 'wb') as o:
-            pickle.dump(self.explanation_cache, o)
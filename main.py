@@ -6,7 +6,14 @@ Date:           10-11-2020
 Description:    This script is the entry point for annotating named
                 entities in a text with explanations.
 
-Usage:          python3 main.py <text> -v(erbose) -
+                By default the results are appended to OUTPUT_RAW as JSON
+                lines. With --format parquet or arrow they are written to
+                a documents and an entities table in OUTPUT_COLUMNAR
+                instead (needs pyarrow), see 'support/columnar.py'.
+
+Usage:          python3 main.py <text> -v(erbose) -t(arget) <n>
+                                -b(atch-size) <n> -w(orkers) <n>
+                                -c(hunk-size) <n> -f(ormat) <format>
 '''
 
 
@@ -15,11 +22,360 @@ import csv
 import json
 import pickle
 import sys
+import threading
+import traceback
+from itertools import islice
+from multiprocessing import Event, Process, Queue
+from queue import Full
 
 import spacy
 
 from entity_linker import EntityLinker, EntityLinkerStatus
+from support import columnar
 from support.config import Config
+from utils import count_documents, read_corpus
+
+
+def annotate_documents(e, found):
+    '''
+    Annotates a batch of (text, found entities) tuples at once, returns
+    the results that are 'interesting' (contain annotated or ignored
+    entities) in the same order.
+    '''
+    # If we have a file without entities or with other errors
+    # we will skip it so the program does not crash
+    found = [
+        (text, found_entities) for text, found_entities in found
+        if found_entities['status'] == EntityLinkerStatus.OK
+    ]
+
+    if len(found) == 0:
+        return []
+
+    texts, found_entities = zip(*found)
+
+    # We only want to find some interesting examples to validate
+    return [
+        res for res in e.annotate_many(found_entities, texts)
+        if (len(res['ignored_entities']) != 0 or
+            len(res['annotated_entities']) != 0)
+    ]
+
+
+class JsonLinesWriter():
+    '''
+    This writes a JSON string per line to a txt file, not the prettiest
+    but allows for appending, which is hard with plain JSON.
+    To rebuild (part of) the txt file, just read it per line and
+    parse the JSON.
+    '''
+
+    def __init__(self, path):
+        self.f = open(path, 'a', encoding="utf8")
+
+    def write(self, res):
+        self.f.write(f'{json.dumps(res)}\n')
+
+    def close(self):
+        self.f.close()
+
+
+def open_output(output_format):
+    ''' Returns a writer with 'write' and 'close' for the given format '''
+    if output_format == 'jsonl':
+        return JsonLinesWriter(Config.OUTPUT_RAW)
+
+    return columnar.ColumnarWriter(
+        Config.OUTPUT_COLUMNAR,
+        output_format,
+        Config.COLUMNAR_BATCH_SIZE
+    )
+
+
+class CorpusSize():
+    '''
+    Counts the documents of the corpus in a background thread, this is
+    only used to report the progress. Shows '?' until it is done, so the
+    annotating can start right away.
+    '''
+
+    def __init__(self, path):
+        self.total = None
+
+        threading.Thread(
+            target=self.__count,
+            args=(path,),
+            daemon=True
+        ).start()
+
+    def __count(self, path):
+        self.total = count_documents(path)
+
+    def __str__(self):
+        return '?' if self.total is None else str(self.total)
+
+
+class TargetCounter():
+    '''
+    Keeps track of the amount of written results per explanation
+    needed and not needed.
+    '''
+
+    def __init__(self, target):
+        self.target = target
+        self.count_with = 0
+        self.count_without = 0
+
+    def reached(self):
+        return (self.count_with >= self.target and
+                self.count_without >= self.target)
+
+    def add(self, res):
+        if len(res['annotated_entities']) != 0:
+            self.count_with += 1
+        else:
+            self.count_without += 1
+
+
+def run_serial(corpus, total, args):
+    e = EntityLinker(verbose=args.verbose)
+
+    # This can help with letting the system create a certain amount of
+    # interesing results for validation for example
+    counter = TargetCounter(args.target)
+
+    output = open_output(args.format)
+
+    try:
+        # Spotlight already works on the next documents while the current
+        # ones are annotated, see 'find_iter'.
+        found = e.find_iter(corpus)
+        batches = iter(lambda: list(islice(found, args.batch_size)), [])
+
+        for i, batch in enumerate(batches):
+            if counter.reached():
+                break
+
+            args.verbose and print(
+                f"\rDoc {i * args.batch_size} from {total}"
+            )
+
+            for res in annotate_documents(e, batch):
+                if counter.reached():
+                    break
+
+                counter.add(res)
+                output.write(res)
+    finally:
+        output.close()
+
+    args.verbose and counter.reached() and print(
+        f'Target of {args.target} reached.'
+    )
+
+
+class WorkerDone():
+    '''
+    Sent by a worker (or by the main process for a worker that died)
+    when it stops. <error> is a traceback or None if nothing went wrong.
+    '''
+
+    def __init__(self, worker_id, error=None):
+        self.worker_id = worker_id
+        self.error = error
+
+
+def annotate_worker(worker_id, doc_queue, result_queue, stop, verbose):
+    '''
+    Worker process that annotates chunks of documents. Every worker has
+    its own EntityLinker, so spacy and the lookup tables are only loaded
+    once per worker. Always sends a WorkerDone when it stops, with the
+    error if something went wrong. An error stops all other workers.
+    '''
+    error = None
+
+    try:
+        e = EntityLinker(verbose=verbose)
+
+        while True:
+            chunk = doc_queue.get()
+
+            if chunk is None:
+                break
+
+            # The target is reached, we only need to empty the queue
+            if stop.is_set():
+                continue
+
+            for res in annotate_documents(
+                e,
+                zip(chunk, e.find_many(chunk))
+            ):
+                result_queue.put(res)
+    except Exception:
+        error = traceback.format_exc()
+        stop.set()
+    finally:
+        result_queue.put(WorkerDone(worker_id, error))
+
+
+def write_results(result_queue, stop, failed, target, workers, verbose,
+                  output_format):
+    '''
+    The only process that writes to the output file. Because all results
+    pass through here, this is also where the target is counted. Stops
+    when every worker is done.
+    '''
+    counter = TargetCounter(target)
+    finished = set()
+
+    output = open_output(output_format)
+
+    try:
+        while len(finished) < workers:
+            res = result_queue.get()
+
+            if isinstance(res, WorkerDone):
+                finished.add(res.worker_id)
+
+                if res.error is not None:
+                    print(f'Worker {res.worker_id} failed:\n{res.error}')
+                    failed.set()
+                    stop.set()
+                continue
+
+            # Workers might still be busy with their last chunk
+            if counter.reached():
+                continue
+
+            counter.add(res)
+            output.write(res)
+
+            if counter.reached():
+                verbose and print(f'Target of {target} reached.')
+                stop.set()
+    finally:
+        output.close()
+
+
+def check_workers(workers, reported, result_queue, stop):
+    '''
+    A worker that is killed (or crashes in a way that skips its
+    'finally') never sends a WorkerDone, so we send it for it.
+    '''
+    for worker_id, p in enumerate(workers):
+        if worker_id in reported or p.is_alive():
+            continue
+
+        reported.add(worker_id)
+
+        if p.exitcode != 0:
+            stop.set()
+            result_queue.put(WorkerDone(
+                worker_id,
+                f'Process exited with code {p.exitcode}'
+            ))
+
+
+def check_writer(writer, stop, failed, result_queue):
+    '''
+    Returns whether the writer died. Nobody reads the results anymore
+    then, so everything is stopped.
+    '''
+    if writer.is_alive() or writer.exitcode == 0:
+        return False
+
+    failed.set()
+    stop.set()
+
+    # Otherwise this process blocks on exit flushing results nobody reads
+    result_queue.cancel_join_thread()
+
+    return True
+
+
+def put_while_alive(queue, item, workers):
+    '''
+    Puts an item on the bounded queue, but gives up when no worker is
+    left to take it. Returns whether the item was put on the queue.
+    '''
+    while True:
+        try:
+            queue.put(item, timeout=1)
+            return True
+        except Full:
+            if not any(p.is_alive() for p in workers):
+                return False
+
+
+def run_parallel(corpus, total, args):
+    ''' Returns False if one of the workers or the writer failed '''
+    # The queue is bounded, so we do not put the whole corpus in it
+    doc_queue = Queue(maxsize=args.workers * 2)
+    result_queue = Queue()
+    stop = Event()
+    failed = Event()
+
+    workers = [
+        Process(
+            target=annotate_worker,
+            args=(i, doc_queue, result_queue, stop, args.verbose),
+        )
+        for i in range(args.workers)
+    ]
+    writer = Process(
+        target=write_results,
+        args=(
+            result_queue,
+            stop,
+            failed,
+            args.target,
+            args.workers,
+            args.verbose,
+            args.format,
+        ),
+    )
+
+    for p in workers + [writer]:
+        p.start()
+
+    # Workers that are dead and have a WorkerDone sent
+    reported = set()
+    chunks = iter(lambda: list(islice(corpus, args.chunk_size)), [])
+
+    for i, chunk in enumerate(chunks):
+        check_workers(workers, reported, result_queue, stop)
+        check_writer(writer, stop, failed, result_queue)
+
+        if stop.is_set():
+            break
+
+        args.verbose and print(
+            f"\rDoc {i * args.chunk_size} from {total}"
+        )
+
+        if not put_while_alive(doc_queue, chunk, workers):
+            break
+
+    for _ in workers:
+        if not put_while_alive(doc_queue, None, workers):
+            break
+
+    while any(p.is_alive() for p in workers):
+        check_workers(workers, reported, result_queue, stop)
+
+        # The workers would block on exit, flushing their results
+        if check_writer(writer, stop, failed, result_queue):
+            for p in workers:
+                p.terminate()
+
+        for p in workers:
+            p.join(timeout=1)
+
+    check_workers(workers, reported, result_queue, stop)
+    writer.join()
+
+    return not failed.is_set() and writer.exitcode == 0
 
 
 def main():
@@ -40,63 +396,64 @@ def main():
                   The choice outputs <target> per explanation needed and \
                   not needed. Default is 500."
         )
+        parser.add_argument(
+            "-b",
+            "--batch-size",
+            type=int,
+            default=50,
+            help="Number of documents that are annotated (parsed by \
+                  spacy) at the same time. Default is 50."
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes that annotate documents. Every \
+                  worker loads its own spacy model. Default is 1."
+        )
+        parser.add_argument(
+            "-c",
+            "--chunk-size",
+            type=int,
+            default=50,
+            help="Number of documents a worker gets at a time. \
+                  Only used with more than 1 worker. Default is 50."
+        )
+        parser.add_argument(
+            "-f",
+            "--format",
+            choices=['jsonl', 'parquet', 'arrow'],
+            default='jsonl',
+            help="Output format, 'jsonl' appends to OUTPUT_RAW, 'parquet' \
+                  and 'arrow' write tables to OUTPUT_COLUMNAR. Default is \
+                  jsonl."
+        )
         parser.add_argument(
             "path",
             help="Path to corpus file"
         )
         args = parser.parse_args()
+
+        if args.format != 'jsonl' and not columnar.available():
+            parser.error(f'--format {args.format} needs pyarrow')
     except ValueError:
         print(__doc__)
         exit()
 
-    with open(args.path, 'r', encoding='utf8') as f:
-        # This particular splitting assumes the use of a raw
-        # DutchWebCorpus txt file!
-        test_corpus = [s.replace('\n', ' ') for s in f.read().split('\n\n')]
+    # This particular splitting assumes the use of a raw
+    # DutchWebCorpus txt file! The documents are read lazily.
+    test_corpus = read_corpus(args.path)
 
-    e = EntityLinker(verbose=args.verbose)
-
-    # This can help with letting the system create a certain amount of
-    # interesing results for validation for example
-    count_with, count_without = 0, 0
-    target = args.target
-
-    # This writes a JSON string per line to a txt file, not the prettiest
-    # but allows for appending, which is hard with plain JSON.
-    # To rebuild (part of) the txt file, just read it per line and
-    # parse the JSON.
-    with open(Config.OUTPUT_RAW, 'a', encoding="utf8") as f:
-        for i, text in enumerate(test_corpus):
-            if (count_with >= target and count_without >= target):
-                args.verbose and print(f'Target of {target} reached.')
-                break
-
-            args.verbose and i % 100 == 0 and print(
-                f"\rDoc {i} from {len(test_corpus)}"
-            )
-
-            found_entities = e.find(text)
-
-            # If we have a file without entities or with other errors
-            # we will skip it so the program does not crash
-            if found_entities['status'] != EntityLinkerStatus.OK:
-                continue
-
-            res = e.annotate(found_entities, text)
-
-            # We only want to find some interesting examples to validate
-            if (len(res['ignored_entities']) == 0 and
-                    len(res['annotated_entities']) == 0):
-                continue
-
-            if len(res['annotated_entities']) != 0:
-                count_with += 1
-                f.write(f'{json.dumps(res)}\n')
-                continue
+    # Counting the documents is only needed to report the progress,
+    # for big corpora this takes a moment.
+    total = CorpusSize(args.path) if args.verbose else None
 
-            if len(res['ignored_entities']) != 0:
-                count_without += 1
-                f.write(f'{json.dumps(res)}\n')
+    if args.workers > 1:
+        if not run_parallel(test_corpus, total, args):
+            sys.exit('Annotating stopped because a process failed')
+    else:
+        run_serial(test_corpus, total, args)
 
 
 if __name__ == "__main__":
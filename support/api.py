@@ -13,17 +13,35 @@ Description:    This is the web api used for annotating / validating
                 A skeleton html file is provided. You need to add the
                 API url to that file and (optionally) add some styling.
 
+                The ids of the items that still need validations are kept
+                in memory (see 'PendingPool'), so getting a random item
+                does not need to scan and sort the whole table. Every
+                process has its own pool, so an item is checked in the db
+                before it is handed out.
+
+                Votes are counted with atomic updates and every vote is
+                also stored in a separate table. A single thread writes
+                the votes, multiple votes that arrive at about the same
+                time are committed together (see 'VoteWriter'). A request
+                only returns after its vote is committed.
+
 Usage:          python3 api.py
 '''
 
 import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
 
 from flask import Flask
 from flask_cors import CORS
 from flask_restful import (Api, Resource, abort, fields, marshal_with,
                            reqparse, request)
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.sql.expression import func
+from sqlalchemy import event, select
 
 from config import Config
 
@@ -41,6 +59,18 @@ if not os.path.isfile(Config.VALIDATION_DB):
     )
 
 
+@event.listens_for(db.engine, 'connect')
+def set_sqlite_pragmas(connection, _):
+    # With WAL the readers do not block the writer (and the other way
+    # around), a normal sync is still safe in WAL mode. This is only set
+    # for the engine of the validation db, not for every engine.
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.execute('PRAGMA busy_timeout = 30000')
+    cursor.close()
+
+
 class ValidationModel(db.Model):
     id = db.Column(db.Integer, primary_key=True)
 
@@ -57,7 +87,215 @@ class ValidationModel(db.Model):
     # Validation counts
     total_with_explanation = db.Column(db.Integer, default=0)
     total_without_explanation = db.Column(db.Integer, default=0)
-    total_validations = db.Column(db.Integer, default=0)
+    total_validations = db.Column(db.Integer, default=0, index=True)
+
+
+class ValidationVote(db.Model):
+    ''' Every single vote, this table is only appended to '''
+    id = db.Column(db.Integer, primary_key=True)
+    validation_id = db.Column(
+        db.Integer,
+        db.ForeignKey('validation_model.id'),
+        nullable=False,
+        index=True
+    )
+    choice = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# Number of validations an item needs, so the IAA can be calculated
+VALIDATIONS_NEEDED = 2
+
+
+class PendingPool():
+    '''
+    The ids of the items that need more validations. A random id is
+    picked and removed in constant time, the list is only read from the
+    db once (on the first request).
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = None
+        self.positions = None
+
+    def __load(self):
+        # The index is created by 'create_all' for new databases,
+        # this is for databases that were created before.
+        db.session.execute(
+            'CREATE INDEX IF NOT EXISTS ix_validation_model_total_validations \
+            ON validation_model (total_validations)'
+        )
+        db.session.commit()
+
+        rows = db.session \
+            .query(ValidationModel.id) \
+            .filter(ValidationModel.total_validations < VALIDATIONS_NEEDED) \
+            .all()
+
+        self.ids = [row.id for row in rows]
+        self.positions = {x: i for i, x in enumerate(self.ids)}
+
+    def __len__(self):
+        with self.lock:
+            return 0 if self.ids is None else len(self.ids)
+
+    def sample(self, last_id=None):
+        ''' Returns a random pending id that is not <last_id> or None '''
+        with self.lock:
+            if self.ids is None:
+                self.__load()
+
+            if len(self.ids) == 0:
+                return None
+
+            if len(self.ids) == 1:
+                return None if self.ids[0] == last_id else self.ids[0]
+
+            while True:
+                x = self.ids[random.randrange(len(self.ids))]
+
+                if x != last_id:
+                    return x
+
+    def discard(self, x):
+        ''' Removes an id by moving the last id to its place '''
+        with self.lock:
+            if self.ids is None or x not in self.positions:
+                return
+
+            i = self.positions.pop(x)
+            last = self.ids.pop()
+
+            if last != x:
+                self.ids[i] = last
+                self.positions[last] = i
+
+
+pending = PendingPool()
+
+
+class VoteWriter():
+    '''
+    Writes the votes in a single background thread. The thread waits a
+    short moment for more votes, so a group of votes is committed at
+    once. Every vote gets a Future with True if it is counted or False
+    if the validation id does not exist.
+    '''
+
+    # The column that is increased per choice
+    CHOICE_COLUMNS = {
+        'with': ValidationModel.total_with_explanation,
+        'without': ValidationModel.total_without_explanation,
+    }
+
+    def __init__(self, batch_size, batch_wait):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def vote(self, validation_id, choice):
+        ''' Adds a vote, returns a Future that is done after the commit '''
+        with self.lock:
+            if self.thread is None:
+                # Databases created before the votes table existed
+                ValidationVote.__table__.create(db.engine, checkfirst=True)
+
+                self.thread = threading.Thread(target=self.__run, daemon=True)
+                self.thread.start()
+
+        future = Future()
+        self.queue.put((validation_id, choice, future))
+        return future
+
+    def __next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def __run(self):
+        while True:
+            batch = self.__next_batch()
+
+            try:
+                counted, done = self.__write(batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for x in done:
+                pending.discard(x)
+
+            for counted_vote, (_, _, future) in zip(counted, batch):
+                future.set_result(counted_vote)
+
+    def __write(self, batch):
+        '''
+        Writes a batch in one transaction. Returns whether every vote is
+        counted and the ids that have enough validations now.
+        '''
+        table = ValidationModel.__table__
+        counted = []
+
+        with db.engine.begin() as conn:
+            for validation_id, choice, _ in batch:
+                column = self.CHOICE_COLUMNS[choice]
+
+                # The counts are increased by the db itself, so no vote
+                # is lost when another process updates the same row.
+                result = conn.execute(
+                    table.update()
+                    .where(table.c.id == validation_id)
+                    .values({
+                        column: column + 1,
+                        table.c.total_validations:
+                            table.c.total_validations + 1,
+                    })
+                )
+                counted.append(result.rowcount > 0)
+
+            votes = [
+                {
+                    'validation_id': validation_id,
+                    'choice': choice,
+                    'created_at': datetime.utcnow(),
+                }
+                for counted_vote, (validation_id, choice, _)
+                in zip(counted, batch) if counted_vote
+            ]
+
+            if len(votes) > 0:
+                conn.execute(ValidationVote.__table__.insert(), votes)
+
+            ids = {x['validation_id'] for x in votes}
+
+            done = [
+                row.id for row in conn.execute(
+                    select([table.c.id])
+                    .where(table.c.id.in_(ids))
+                    .where(table.c.total_validations >= VALIDATIONS_NEEDED)
+                )
+            ] if len(ids) > 0 else []
+
+        return counted, done
+
+
+votes = VoteWriter(Config.VOTE_BATCH_SIZE, Config.VOTE_BATCH_WAIT)
 
 
 validation_put_args = reqparse.RequestParser()
@@ -88,39 +326,29 @@ class Validation(Resource):
         # two times in a row and IAA can be calculated.
         last_id = request.args.get('last', default=None, type=int)
 
-        result = ValidationModel \
-            .query \
-            .filter(
-                ValidationModel.total_validations < 2,
-                ValidationModel.id != last_id
-            ) \
-            .order_by(func.random()) \
-            .first()
+        while True:
+            validation_id = pending.sample(last_id)
 
-        return result
-
-    def post(self):
-        values = validation_put_args.parse_args()
-        validation = ValidationModel \
-            .query \
-            .filter_by(id=values['id']) \
-            .first()
+            if validation_id is None:
+                return None
 
-        if not validation:
-            abort(404, message='The validation id is invalid')
+            result = ValidationModel.query.get(validation_id)
 
-        if values['choice'] not in ['with', 'without']:
-            abort(422, message='The provided choice is invalid')
+            # The pool can be behind when another process got the votes
+            if (result is not None and
+                    result.total_validations < VALIDATIONS_NEEDED):
+                return result
 
-        if values['choice'] == 'with':
-            validation.total_with_explanation += 1
+            pending.discard(validation_id)
 
-        if values['choice'] == 'without':
-            validation.total_without_explanation += 1
+    def post(self):
+        values = validation_put_args.parse_args()
 
-        validation.total_validations += 1
+        if values['choice'] not in VoteWriter.CHOICE_COLUMNS:
+            abort(422, message='The provided choice is invalid')
 
-        db.session.commit()
+        if not votes.vote(values['id'], values['choice']).result():
+            abort(404, message='The validation id is invalid')
 
 
 api.add_resource(Validation, '/validation')
@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+'''
+File name:      benchmark_api.py
+Date:           17-10-2026
+Description:    Load test for 'api.py'. Creates a temporary database
+                with <items> generated validation items, starts the api
+                on a local port and lets <clients> annotators validate
+                at the same time. Every annotator repeatedly gets an item
+                and votes on it, just like 'validation.html' does.
+
+                The api runs in its own process, so the annotators do not
+                compete with it for the GIL.
+
+                The p50, p95 and p99 latency and the requests per second
+                are reported for GET and POST /validation. The real
+                database in the data folder is not touched.
+
+Usage:          python benchmark_api.py [--items <n>] [--clients <n>]
+                    [--requests <n>] [--seed <n>]
+'''
+
+import argparse
+import logging
+import multiprocessing
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+from werkzeug.serving import make_server
+
+from config import Config
+
+
+def generate_rows(n, rng):
+    ''' Yields <n> fake validation items '''
+    for i in range(n):
+        yield {
+            'entity': f'entity {i}',
+            'extract': 'Extract of the entity.',
+            'score': rng.random(),
+            'with_explanation_raw': f'Context with entity {i} (explained).',
+            'with_explanation': f'Context with <b>entity {i}</b> (explained).',
+            'without_explanation': f'Context with entity {i}.',
+            'system_decision': rng.choice(['with', 'without']),
+            'system_choice': rng.choice(['CONTEXT', 'COMMON_KNOWLEDGE']),
+        }
+
+
+def serve(db_path, port_queue):
+    '''
+    Runs the api on a free local port until the process is terminated,
+    the port is put on <port_queue> as soon as the server is listening.
+    '''
+    # The api uses the db from the config as soon as it is imported
+    Config.VALIDATION_DB = db_path
+
+    import api
+
+    # Only the results are interesting, not every request
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    server = make_server('127.0.0.1', 0, api.app, threaded=True)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def annotator(url, n_requests, seed, result):
+    '''
+    Gets and votes on <n_requests> items, stores (method, seconds) tuples
+    in result['timings'] and the number of failed requests per method in
+    result['errors']. Every annotator has its own result.
+    '''
+    timings = result['timings']
+    errors = result['errors']
+    rng = random.Random(seed)
+    session = requests.Session()
+    last_id = None
+
+    for _ in range(n_requests):
+        params = {} if last_id is None else {'last': last_id}
+
+        start = time.perf_counter()
+        response = session.get(url, params=params)
+        timings.append(('GET', time.perf_counter() - start))
+
+        if response.status_code != 200:
+            errors['GET'] += 1
+            continue
+
+        last_id = response.json()['id']
+
+        # Everything is validated already
+        if not last_id:
+            break
+
+        start = time.perf_counter()
+        response = session.post(url, data={
+            'id': last_id,
+            'choice': rng.choice(['with', 'without']),
+        })
+        timings.append(('POST', time.perf_counter() - start))
+
+        if response.status_code != 200:
+            errors['POST'] += 1
+
+
+def percentile(values, p):
+    ''' Nearest rank percentile of sorted values '''
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(timings, errors, seconds):
+    print(f'{"":6}{"n":>8}{"errors":>8}{"rps":>10}'
+          f'{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+
+    for method in ['GET', 'POST', None]:
+        values = sorted(t for m, t in timings if method in (None, m))
+
+        if len(values) == 0:
+            continue
+
+        n_errors = sum(errors.values()) if method is None else errors[method]
+
+        print(
+            f'{method or "ALL":6}{len(values):>8}{n_errors:>8}'
+            f'{len(values) / seconds:>10.1f}'
+            f'{percentile(values, 50) * 1000:>10.2f}'
+            f'{percentile(values, 95) * 1000:>10.2f}'
+            f'{percentile(values, 99) * 1000:>10.2f}'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--items",
+        type=int,
+        default=20000,
+        help="Number of items in the generated database, default is 20000"
+    )
+    parser.add_argument(
+        "-c",
+        "--clients",
+        type=int,
+        default=16,
+        help="Number of annotators at the same time, default is 16"
+    )
+    parser.add_argument(
+        "-r",
+        "--requests",
+        type=int,
+        default=200,
+        help="Number of items every annotator validates, default is 200"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the generated items and votes, default is 0"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # The api uses the db from the config as soon as it is imported
+        Config.VALIDATION_DB = Path(tmp_dir) / 'benchmark.db'
+        open(Config.VALIDATION_DB, 'w').close()
+
+        import api
+        from select_data_for_validation import insert_rows
+
+        api.db.create_all()
+
+        start = time.perf_counter()
+        total = insert_rows(
+            generate_rows(args.items, random.Random(args.seed)),
+            1000
+        )
+        print(
+            f'Created database with {total} items in \
+            {time.perf_counter() - start:.2f}s'
+        )
+
+        # The server process opens the db on its own
+        api.db.session.remove()
+        api.db.engine.dispose()
+
+        # A fresh interpreter, so nothing of this process is shared
+        context = multiprocessing.get_context('spawn')
+        port_queue = context.Queue()
+        server = context.Process(
+            target=serve,
+            args=(Config.VALIDATION_DB, port_queue),
+            daemon=True,
+        )
+        server.start()
+        url = f'http://127.0.0.1:{port_queue.get(timeout=60)}/validation'
+
+        results = [
+            {'timings': [], 'errors': {'GET': 0, 'POST': 0}}
+            for _ in range(args.clients)
+        ]
+        clients = [
+            threading.Thread(
+                target=annotator,
+                args=(url, args.requests, args.seed + i, result),
+            )
+            for i, result in enumerate(results)
+        ]
+
+        start = time.perf_counter()
+
+        for client in clients:
+            client.start()
+
+        for client in clients:
+            client.join()
+
+        seconds = time.perf_counter() - start
+
+        server.terminate()
+        server.join()
+
+        print(
+            f'{args.clients} annotators, {args.requests} items each, \
+            {seconds:.2f}s'
+        )
+        report(
+            [t for result in results for t in result['timings']],
+            {
+                method: sum(result['errors'][method] for result in results)
+                for method in ['GET', 'POST']
+            },
+            seconds
+        )
+
+
+if __name__ == '__main__':
+    main()
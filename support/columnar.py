@@ -0,0 +1,239 @@
+'''
+File name:      columnar.py
+Date:           17-10-2026
+Description:    Columnar output of 'main.py' as Parquet or Arrow IPC
+                files, this needs pyarrow (which is optional otherwise).
+
+                The results are split in two tables, each in their own
+                folder in the output folder:
+                    documents: document_id, input_text, output_text,
+                               annotated, ignored (number of entities)
+                    entities:  document_id, decision, entity, score,
+                               choice, offset, explanation, extract and
+                               the contexts
+
+                Every run writes a new part file per table, the rows are
+                written in row groups (Parquet) or record batches (Arrow)
+                of <batch_size> documents. Reading only decodes the
+                columns that are asked for and the files are memory
+                mapped, so the texts of the documents are not read when
+                only the entities are needed.
+'''
+
+import os
+from datetime import datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from pyarrow import ipc
+except ImportError:
+    pa = None
+
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Same mapping as the labels used in the validation
+DECISIONS = {'annotated_entities': 'with', 'ignored_entities': 'without'}
+
+DOCUMENT_COLUMNS = [
+    ('document_id', 'string'),
+    ('input_text', 'string'),
+    ('output_text', 'string'),
+    ('annotated', 'int32'),
+    ('ignored', 'int32'),
+]
+
+ENTITY_COLUMNS = [
+    ('document_id', 'string'),
+    ('decision', 'string'),
+    ('entity', 'string'),
+    ('score', 'float64'),
+    ('choice', 'string'),
+    ('offset', 'int64'),
+    ('explanation', 'string'),
+    ('extract', 'string'),
+    ('context_with_explanation', 'string'),
+    ('context_without_explanation', 'string'),
+    ('context_highlighted', 'string'),
+]
+
+
+def available():
+    return pa is not None
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError(
+            'The columnar output needs pyarrow, install it with \
+            \'pip install pyarrow\''
+        )
+
+
+def _schema(columns):
+    return pa.schema([(name, pa.type_for_alias(t)) for name, t in columns])
+
+
+class ColumnarWriter():
+    ''' Writes 'annotate' results to a documents and an entities table '''
+
+    def __init__(self, folder, output_format='parquet', batch_size=1000):
+        _require_pyarrow()
+
+        if output_format not in FORMATS:
+            raise ValueError(f'Unknown columnar format {output_format}')
+
+        self.folder = folder
+        self.output_format = output_format
+        self.batch_size = batch_size
+
+        # Document ids are unique over runs, since every run appends
+        date = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        self.run = f'{date}_{os.getpid()}'
+        self.n_documents = 0
+
+        self.tables = {
+            'documents': DOCUMENT_COLUMNS,
+            'entities': ENTITY_COLUMNS,
+        }
+        self.schemas = {
+            name: _schema(columns) for name, columns in self.tables.items()
+        }
+        self.buffers = {}
+        self.writers = {}
+        self.sinks = {}
+
+        for name, schema in self.schemas.items():
+            self.__open(name, schema)
+
+        self.__reset()
+
+    def __open(self, name, schema):
+        os.makedirs(os.path.join(self.folder, name), exist_ok=True)
+        path = os.path.join(
+            self.folder,
+            name,
+            f'part-{self.run}{FORMATS[self.output_format]}'
+        )
+
+        if self.output_format == 'parquet':
+            self.writers[name] = pq.ParquetWriter(path, schema)
+        else:
+            self.sinks[name] = pa.OSFile(path, 'wb')
+            self.writers[name] = ipc.new_file(self.sinks[name], schema)
+
+    def __reset(self):
+        self.buffered = 0
+        self.buffers = {
+            name: {column: [] for column, _ in columns}
+            for name, columns in self.tables.items()
+        }
+
+    def write(self, res):
+        document_id = f'{self.run}:{self.n_documents}'
+        self.n_documents += 1
+
+        documents = self.buffers['documents']
+        documents['document_id'].append(document_id)
+        documents['input_text'].append(res['input_text'])
+        documents['output_text'].append(res['output_text'])
+        documents['annotated'].append(len(res['annotated_entities']))
+        documents['ignored'].append(len(res['ignored_entities']))
+
+        entities = self.buffers['entities']
+
+        for key, decision in DECISIONS.items():
+            for ann in res[key]:
+                entities['document_id'].append(document_id)
+                entities['decision'].append(decision)
+
+                for column, _ in ENTITY_COLUMNS[2:]:
+                    entities[column].append(ann[column])
+
+        self.buffered += 1
+
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        ''' Writes the buffered rows as a row group / record batch '''
+        if self.buffered == 0:
+            return
+
+        for name, schema in self.schemas.items():
+            table = pa.Table.from_pydict(self.buffers[name], schema=schema)
+            self.writers[name].write_table(table)
+
+        self.__reset()
+
+    def close(self):
+        self.flush()
+
+        for writer in self.writers.values():
+            writer.close()
+
+        for sink in self.sinks.values():
+            sink.close()
+
+
+def part_paths(folder, name):
+    ''' Returns the part files of a table, oldest run first '''
+    table_folder = os.path.join(folder, name)
+
+    if not os.path.isdir(table_folder):
+        return []
+
+    return sorted(
+        os.path.join(table_folder, x) for x in os.listdir(table_folder)
+        if x.endswith(tuple(FORMATS.values()))
+    )
+
+
+def read_rows(folder, name, columns):
+    '''
+    Yields the rows of a table as dicts with only the given columns,
+    the part files are memory mapped and read batch by batch.
+    '''
+    _require_pyarrow()
+
+    for path in part_paths(folder, name):
+        if path.endswith(FORMATS['parquet']):
+            batches = pq.ParquetFile(path, memory_map=True) \
+                .iter_batches(columns=columns)
+        else:
+            # Reading a memory mapped Arrow file does not copy anything
+            batches = ipc.open_file(pa.memory_map(path)) \
+                .read_all() \
+                .select(columns) \
+                .to_batches()
+
+        for batch in batches:
+            yield from batch.to_pylist()
+
+
+def read_entity_documents(folder, columns):
+    '''
+    Yields the entities grouped per document in the same structure as
+    the JSON output ('annotated_entities' and 'ignored_entities'), but
+    only with the given entity columns. The texts are not read.
+    '''
+    keys = {decision: key for key, decision in DECISIONS.items()}
+    document_id, document = None, None
+
+    rows = read_rows(folder, 'entities', ['document_id', 'decision'] + [
+        x for x in columns if x not in ('document_id', 'decision')
+    ])
+
+    for row in rows:
+        if row['document_id'] != document_id:
+            if document is not None:
+                yield document
+
+            document_id = row['document_id']
+            document = {key: [] for key in DECISIONS}
+
+        del row['document_id']
+        document[keys[row.pop('decision')]].append(row)
+
+    if document is not None:
+        yield document
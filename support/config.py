@@ -8,8 +8,27 @@ class Config():
     # --- General ---
     SPACY_MODEL = 'nl_core_news_lg'
 
+    # Used for 'nlp.pipe' when annotating multiple texts at once
+    SPACY_BATCH_SIZE = 256
+    SPACY_N_PROCESS = 1
+
     WIKI_API_URL = 'https://nl.wikipedia.org/api/rest_v1/page/summary/'
 
+    # Max number of concurrent requests to the Wikipedia api
+    WIKI_MAX_WORKERS = 8
+
+    # Used for all http requests, backoff is in seconds
+    HTTP_RETRIES = 3
+    HTTP_BACKOFF = 0.5
+    HTTP_TIMEOUT = 10
+
+    # Max number of Spotlight requests in flight at the same time
+    SPOTLIGHT_MAX_WORKERS = 4
+
+    # These are stripped from the keys and values in the wiki lookup table
+    DBPEDIA_RESOURCE_PREFIX = 'http://nl.dbpedia.org/resource/'
+    WIKI_PAGE_PREFIX = 'http://nl.wikipedia.org/wiki/'
+
     # Default local url for Dutch Model
     SPOTLIGHT_API_URL = 'http://0.0.0.0:2232/rest/annotate'
 
@@ -18,22 +37,62 @@ class Config():
 
     OUTPUT_RAW = DATA_FOLDER / 'out.txt'
 
+    # Used instead of OUTPUT_RAW with 'main.py --format parquet/arrow',
+    # results are written in batches of this many documents
+    OUTPUT_COLUMNAR = DATA_FOLDER / 'out_columnar'
+    COLUMNAR_BATCH_SIZE = 1000
+
     # Credits stopwords: https://eikhart.com/nl/blog/moderne-stopwoorden-lijst
     STOP_WORDS_RAW = DATA_FOLDER / 'stopwoorden.txt'
 
+    # Old pickled cache, only used for migrating to the sqlite store
+    # or when the 'pickle' backend is chosen
     EXPLANATION_CACHE = DATA_FOLDER / 'explanation_cache.pickle'
 
+    EXPLANATION_CACHE_DB = DATA_FOLDER / 'explanation_cache.db'
+
+    # Either 'sqlite' or 'pickle', see 'cache.py'
+    EXPLANATION_CACHE_BACKEND = 'sqlite'
+
+    # Max number of parsed explanations (with vectors) kept in memory,
+    # all of them are stored in EXPLANATION_CACHE_DB
+    EMBEDDING_CACHE_SIZE = 50000
+
     DBPEDIA_TO_WIKI = DATA_FOLDER / 'dbpedia_to_wiki.txt'
 
+    # Old lookup table, can be converted with 'create_wiki_lookup_table.py'
     WIKI_LOOKUP_PICKLE = DATA_FOLDER / 'wiki_lookup_table.pickle'
 
+    # Compact lookup table that is opened with mmap, see 'frozen_table.py'
+    WIKI_LOOKUP_TABLE = DATA_FOLDER / 'wiki_lookup_table.bin'
+
     ENTITY_COUNTS_PICKLE = DATA_FOLDER / 'all_entity_counts.pickle'
 
+    # Counts per corpus file, merged into ENTITY_COUNTS_PICKLE
+    ENTITY_COUNT_SHARDS = DATA_FOLDER / 'entity_count_shards'
+
+    # Approximate counts (see 'heavy_hitters.py'), same as above
+    ENTITY_COUNTS_SKETCH = DATA_FOLDER / 'all_entity_counts_sketch.pickle'
+
+    ENTITY_SKETCH_SHARDS = DATA_FOLDER / 'entity_sketch_shards'
+
+    # The merged exact counts sorted from most to least common, used (and
+    # updated with new shards) by 'create_entity_blacklist.py'
+    ENTITY_COUNTS_INDEX = DATA_FOLDER / 'all_entity_counts_index.pickle'
+
     ENTITY_COUNTS_CSV = DATA_FOLDER / 'all_entity_counts.csv'
 
     ENTITY_BLACKLIST_RAW = DATA_FOLDER / 'entity_blacklist.txt'
 
     ENTITY_BLACKLIST_PICKLE = DATA_FOLDER / 'entity_blacklist.pickle'
 
+    # Same as the pickle, but memory mapped, see 'frozen_table.py'
+    ENTITY_BLACKLIST_TABLE = DATA_FOLDER / 'entity_blacklist.bin'
+
     # --- API ---
     VALIDATION_DB = DATA_FOLDER / 'database.db'
+
+    # Votes are committed in groups of at most this size, a vote waits at
+    # most this many seconds for others to join its group.
+    VOTE_BATCH_SIZE = 64
+    VOTE_BATCH_WAIT = 0.005
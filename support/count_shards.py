@@ -0,0 +1,229 @@
+'''
+File name:      count_shards.py
+Date:           17-10-2026
+Description:    Helpers for the entity count shards that
+                'create_entity_count.py' writes (one per corpus file) and
+                a sorted form of the merged counts. Only the shards of the
+                last complete count run are used (see 'load_merged').
+
+                SortedCounts keeps the entities ordered from most to least
+                common, so a cutoff (top n, percentage or minimum count) is
+                just a slice. It remembers which shards it contains (with
+                the file_stat from the manifest), new shards can be merged
+                without sorting everything again.
+'''
+
+import heapq
+import json
+import os
+import pickle
+from array import array
+from collections import Counter
+
+from heavy_hitters import SpaceSaving
+
+
+def shard_path(shards, file_name):
+    return shards / f'{file_name}.pickle'
+
+
+def file_stat(entry):
+    ''' Size and modification time of a corpus file (os.DirEntry) '''
+    stat = entry.stat()
+
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def read_manifest(shards):
+    if not os.path.isfile(shards / 'manifest.json'):
+        return {'done': {}}
+
+    with open(shards / 'manifest.json', 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def load_manifest(shards):
+    '''
+    Returns a dictionary with the files that are already counted and the
+    file_stat they had when they were counted. Old manifests only have
+    the names, the stat is None for those.
+    '''
+    done = read_manifest(shards)['done']
+
+    if isinstance(done, list):
+        done = dict.fromkeys(done)
+
+    # A file only counts as done if the shard is still there
+    return {
+        name: stat for name, stat in done.items()
+        if os.path.isfile(shard_path(shards, name))
+    }
+
+
+def load_merged(shards):
+    '''
+    Returns the files (with their file_stat) that the last complete count
+    run merged into the counts pickle. This is empty when there was no
+    such run or a run is unfinished, then only the pickle is complete.
+    The manifest can contain files that are no longer in the corpus.
+    '''
+    merged = read_manifest(shards).get('merged', [])
+    done = load_manifest(shards)
+
+    if any(name not in done for name in merged):
+        return {}
+
+    return {name: done[name] for name in merged}
+
+
+def save_manifest(shards, done, merged=None):
+    '''
+    Without <merged> the counts pickle is not up to date with the shards
+    (anymore), see 'load_merged'.
+    '''
+    manifest = {'done': dict(sorted(done.items()))}
+
+    if merged is not None:
+        manifest['merged'] = sorted(merged)
+
+    # Replacing the file makes sure we never end up with half a manifest
+    tmp_path = shards / 'manifest.json.tmp'
+
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(manifest, f)
+
+    os.replace(tmp_path, shards / 'manifest.json')
+
+
+def merge_shards(shards, file_names, capacity=None):
+    ''' Adds up the counts of all given shards '''
+    entity_counts = Counter() if capacity is None else SpaceSaving(capacity)
+
+    for name in file_names:
+        with open(shard_path(shards, name), 'rb') as f:
+            if capacity is None:
+                entity_counts.update(pickle.load(f))
+            else:
+                entity_counts.merge(pickle.load(f))
+
+    return entity_counts
+
+
+def _by_count(item):
+    return -item[1]
+
+
+class SortedCounts():
+    '''
+    Entity counts sorted from most to least common. The order of entities
+    with the same count is the same as Counter.most_common. <unique> is
+    the number of unique entities, which is only an estimate for
+    approximate counts (not all of them are in the list then). <shards>
+    maps the merged shards to their file_stat, like the manifest.
+    '''
+
+    def __init__(self, items=(), unique=None, source=None, shards=None):
+        self.entities = []
+        self.counts = array('Q')
+
+        for entity, count in items:
+            self.entities.append(entity)
+            self.counts.append(count)
+
+        self.unique = len(self.entities) if unique is None else unique
+        self.source = source
+        self.shards = dict(shards or {})
+
+    @classmethod
+    def from_counter(cls, entity_counts, source=None, shards=None):
+        return cls(entity_counts.most_common(), source=source, shards=shards)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+
+        shards = data['shards']
+
+        # Older indexes only stored the names of the shards
+        if isinstance(shards, list):
+            shards = dict.fromkeys(shards)
+
+        index = cls(source=data['source'], shards=shards)
+        index.entities = data['entities']
+        index.counts = data['counts']
+        index.unique = data['unique']
+
+        return index
+
+    def save(self, path):
+        tmp_path = f'{path}.tmp'
+
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({
+                'entities': self.entities,
+                'counts': self.counts,
+                'unique': self.unique,
+                'source': self.source,
+                'shards': self.shards,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.entities)
+
+    def merge(self, entity_counts, shards=None):
+        '''
+        Adds a Counter (of new shards) to the counts. Only the entities
+        in the Counter change place, those are sorted on their own and
+        merged with the rest, which is still in order.
+        '''
+        changed = Counter(entity_counts)
+        unchanged = []
+
+        for entity, count in zip(self.entities, self.counts):
+            if entity in changed:
+                changed[entity] += count
+            else:
+                unchanged.append((entity, count))
+
+        merged = heapq.merge(
+            unchanged,
+            changed.most_common(),
+            key=_by_count
+        )
+
+        self.entities = []
+        self.counts = array('Q')
+
+        for entity, count in merged:
+            self.entities.append(entity)
+            self.counts.append(count)
+
+        self.unique = len(self.entities)
+        self.shards.update(shards or {})
+
+    def top(self, n):
+        ''' Returns the <n> most common (entity, count) tuples '''
+        return list(zip(self.entities[:n], self.counts[:n]))
+
+    def top_percentage(self, percentage):
+        ''' Same as top, but <percentage> of all unique entities '''
+        return self.top(int(self.unique * percentage / 100))
+
+    def at_least(self, min_count):
+        ''' Returns the (entity, count) tuples with at least <min_count> '''
+        # Binary search for the first count below min_count,
+        # the counts are in descending order.
+        low, high = 0, len(self.counts)
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self.counts[middle] >= min_count:
+                low = middle + 1
+            else:
+                high = middle
+
+        return self.top(low)
@@ -8,52 +8,229 @@ Description:    This script creates a blacklist of very common
                 'common knowledge' and is used in the decision
                 of when an explanation is needed.
 
-                The script 'create_entity_counts.py' produces a
-                pickle file that this script needs.
+                The script 'create_entity_counts.py' produces the
+                counts that this script needs. These are loaded once into
+                a sorted form (ENTITY_COUNTS_INDEX), so every cutoff is
+                cheap. When there are count shards that are not in the
+                sorted counts yet, only those are merged into it (if a
+                shard was counted again, everything is merged again). With
+                --approximate the approximate counts of
+                'create_entity_counts.py --approximate' are used instead.
 
-Usage:          python create_entity_blacklist.py
+                The cutoff is a percentage of all unique entities (default
+                is 1), a minimum count or a fixed number of entities. With
+                a single cutoff the blacklist files from the config are
+                written. Multiple cutoffs can be given to compare them,
+                then every cutoff gets its own files (with the cutoff in
+                the file name).
+
+Usage:          python create_entity_blacklist.py [--approximate]
+                    [--percentage <p> ...] [--min-count <n> ...]
+                    [--top <n> ...]
 '''
 
 
+import argparse
+import os
 import pickle
 import sys
-from collections import Counter
 
 from config import Config
+from count_shards import SortedCounts, load_merged, merge_shards
+from frozen_table import write_table
 
 
-def main():
-    # The entity counts file consists of a Counter
-    # which means tuples of (<entity string>, <count>)
-    with open(Config.ENTITY_COUNTS_PICKLE, 'rb') as f:
+def load_exact_counts():
+    '''
+    Returns the sorted exact counts. The sorted counts are stored, so the
+    next run only has to load them. New shards are merged into them, if
+    the shards are not merged by a complete count run (or there are no
+    shards) the counts pickle is used.
+    '''
+    index = None
+
+    if os.path.isfile(Config.ENTITY_COUNTS_INDEX):
+        index = SortedCounts.load(Config.ENTITY_COUNTS_INDEX)
+
+    # The same shards as the counts pickle, without an unfinished run
+    # or files that were removed from the corpus
+    done = load_merged(Config.ENTITY_COUNT_SHARDS)
+
+    if len(done) > 0:
+        # Counts from the pickle already contain (some of) the shards and
+        # shards that were counted again (or removed) can not be taken out
+        # of the sorted counts, in both cases we start over.
+        if (index is None or index.source != 'shards' or any(
+                done.get(name) != stat
+                for name, stat in index.shards.items())):
+            index = SortedCounts(source='shards')
+
+        new = sorted(done.keys() - index.shards.keys())
+
+        if len(new) == 0:
+            return index
+
+        print(f'Merging {len(new)} new count shards')
+        index.merge(
+            merge_shards(Config.ENTITY_COUNT_SHARDS, new),
+            {name: done[name] for name in new}
+        )
+    else:
+        if (index is not None and index.source == 'pickle' and
+                os.path.getmtime(Config.ENTITY_COUNTS_INDEX) >=
+                os.path.getmtime(Config.ENTITY_COUNTS_PICKLE)):
+            return index
+
+        # The entity counts file consists of a Counter
+        # which means tuples of (<entity string>, <count>)
+        with open(Config.ENTITY_COUNTS_PICKLE, 'rb') as f:
+            index = SortedCounts.from_counter(pickle.load(f), source='pickle')
+
+    index.save(Config.ENTITY_COUNTS_INDEX)
+
+    return index
+
+
+def load_approximate_counts():
+    '''
+    Gets the top entities from the approximate counts, the number
+    of unique entities is an estimate as well.
+    '''
+    with open(Config.ENTITY_COUNTS_SKETCH, 'rb') as f:
         entity_counts = pickle.load(f)
 
-    # This makes a blacklist of the top 1% entities.
-    # On the DutchWebCorpus this means roughly a
-    # cutoff at 118 mentions of that entity in the
-    # corpus. This captures a lot of obvious cases
-    # such as 'Amsterdam' with a huge 135706 mentions.
-    top_counts = entity_counts.most_common(
-        int(len(entity_counts.keys()) * 0.01)
+    print(
+        f'Approximate counts are at most \
+        {entity_counts.error_bound():.1f} too high'
+    )
+
+    return SortedCounts(
+        ((entity, count) for entity, count, _ in entity_counts.most_common()),
+        unique=entity_counts.distinct.estimate(),
+        source='sketch',
     )
 
-    top_entities = {e[0] for e in top_counts}
+
+def get_cutoffs(args):
+    '''
+    Returns a list of (name, function) tuples, the function gets the
+    sorted counts and returns the top (entity, count) tuples.
+    '''
+    cutoffs = []
+
+    for p in args.percentage:
+        cutoffs.append((f'p{p:g}', lambda x, p=p: x.top_percentage(p)))
+
+    for n in args.min_count:
+        cutoffs.append((f'min{n}', lambda x, n=n: x.at_least(n)))
+
+    for n in args.top:
+        cutoffs.append((f'top{n}', lambda x, n=n: x.top(n)))
+
+    return cutoffs
+
+
+def variant_path(path, name):
+    return path.with_name(f'{path.stem}_{name}{path.suffix}')
+
+
+def write_blacklist(top_entities, name=None):
+    paths = [
+        Config.ENTITY_BLACKLIST_PICKLE,
+        Config.ENTITY_BLACKLIST_TABLE,
+        Config.ENTITY_BLACKLIST_RAW,
+    ]
+
+    if name is not None:
+        paths = [variant_path(path, name) for path in paths]
+
+    pickle_path, table_path, raw_path = paths
 
     # We dump this as a set of strings because we only
     # want to know (fast) membership and the counts do not matter
     # in the linking itself, only here.
-    with open(Config.ENTITY_BLACKLIST_PICKLE, 'wb') as f:
+    with open(pickle_path, 'wb') as f:
         pickle.dump(top_entities, f)
 
+    # The same set as a compact file that is memory mapped by every
+    # (worker) process that uses it, see 'frozen_table.py'
+    write_table(table_path, ((e, None) for e in top_entities))
+
     # For debugging and to see what is happening, we also
     # create a raw txt file of the blacklist
-    with open(Config.ENTITY_BLACKLIST_RAW, 'w', encoding='utf8') as f:
+    with open(raw_path, 'w', encoding='utf8') as f:
         f.writelines([f'{e}\n' for e in top_entities])
 
-    print(
-        f'Created blacklist pickle and txt file with \
-        {len(top_entities)} entities.'
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--approximate",
+        help="Use the approximate entity counts",
+        action="store_true"
+    )
+    parser.add_argument(
+        "-p",
+        "--percentage",
+        type=float,
+        nargs="+",
+        default=[],
+        help="Blacklist this percentage of the unique entities"
+    )
+    parser.add_argument(
+        "-m",
+        "--min-count",
+        type=int,
+        nargs="+",
+        default=[],
+        help="Blacklist the entities with at least this many mentions"
+    )
+    parser.add_argument(
+        "-n",
+        "--top",
+        type=int,
+        nargs="+",
+        default=[],
+        help="Blacklist this many of the most common entities"
     )
+    args = parser.parse_args()
+
+    # This makes a blacklist of the top 1% entities by default.
+    # On the DutchWebCorpus this means roughly a
+    # cutoff at 118 mentions of that entity in the
+    # corpus. This captures a lot of obvious cases
+    # such as 'Amsterdam' with a huge 135706 mentions.
+    if not (args.percentage or args.min_count or args.top):
+        args.percentage = [1]
+
+    if args.approximate:
+        entity_counts = load_approximate_counts()
+    else:
+        entity_counts = load_exact_counts()
+
+    cutoffs = get_cutoffs(args)
+
+    for name, cutoff in cutoffs:
+        top_counts = cutoff(entity_counts)
+
+        # Approximate counts only contain the most common entities
+        if (entity_counts.source == 'sketch' and
+                len(top_counts) == len(entity_counts)):
+            print(
+                f'Warning, all {len(entity_counts)} counted entities are \
+                in the blacklist ({name}), maybe more are needed. Use a \
+                higher capacity.'
+            )
+
+        top_entities = {e for e, _ in top_counts}
+        min_count = top_counts[-1][1] if len(top_counts) > 0 else None
+
+        write_blacklist(top_entities, name if len(cutoffs) > 1 else None)
+
+        print(
+            f'Created blacklist pickle, table and txt file ({name}) with \
+            {len(top_entities)} entities, cutoff at {min_count} mentions.'
+        )
 
 
 if __name__ == '__main__':
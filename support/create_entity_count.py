@@ -11,113 +11,317 @@ Description:    This script counts all entities recognized by spacy.
                 from the DutchWebCorpus. It loops trough all txt files
                 in the folder.
 
+                Every file is counted on its own (by multiple processes)
+                into a shard in ENTITY_COUNT_SHARDS. A manifest keeps
+                track of the finished files and their size and mtime, so
+                when something goes wrong a rerun skips those (unless the
+                file changed). At the end the shards of the files in the
+                folder are merged into ENTITY_COUNTS_PICKLE.
+
+                With --approximate <capacity> only (about) the most common
+                entities are counted in a fixed amount of memory, see
+                'heavy_hitters.py'. These shards are stored separately in
+                ENTITY_SKETCH_SHARDS and merged into ENTITY_COUNTS_SKETCH.
+                Use 'validate_heavy_hitters.py' to see how close the
+                approximation is on a sample.
+
+                The spacy pipeline only runs the NER. Multiple lines can
+                be grouped into one document (--lines-per-doc) and the
+                batch size of spacy can be changed (--batch-size). The
+                number of documents per second per process is reported,
+                to find the best settings for a machine.
+
 Usage:          python create_entity_count.py <path_to_raw_folder>
+                    [--processes <n>] [--approximate <capacity>]
+                    [--lines-per-doc <n>] [--batch-size <n>]
+                    [--n-process <n>]
 '''
 
 
+import argparse
 import os
 import pickle
 import sys
+import time
 from collections import Counter
-from multiprocessing import cpu_count
+from itertools import islice
+from multiprocessing import Pool, cpu_count
 
 import spacy
 
 from config import Config
+from count_shards import (file_stat, load_manifest, merge_shards,
+                          save_manifest, shard_path)
+from heavy_hitters import SpaceSaving
+
+# Every worker process loads spacy once, see 'load_nlp'
+nlp = None
+
+
+def load_nlp():
+    global nlp
+
+    # We only need the NER tagger, with everything enabled it is much slower
+    nlp = spacy.load(Config.SPACY_MODEL, disable=['parser', 'tagger'])
+
+    # Just in case the model has other components as well
+    other_pipes = [p for p in nlp.pipe_names if p != 'ner']
+
+    if len(other_pipes) > 0:
+        nlp.disable_pipes(*other_pipes)
+
+
+def group_lines(f, file_name, lines_per_doc):
+    '''
+    Yields (text, (file name, first line number)) tuples with
+    <lines_per_doc> lines per text, spacy is faster on a few larger
+    texts than on a lot of tiny ones. The tuple keeps track of where
+    the text came from.
+    '''
+    line_number = 0
+
+    for lines in iter(lambda: list(islice(f, lines_per_doc)), []):
+        yield ''.join(lines), (file_name, line_number)
+        line_number += len(lines)
+
+
+def count_file(task):
+    '''
+    Counts the entities in a single file and writes them to its shard.
+    The task is a tuple of (file path, file name, shards folder, capacity,
+    pipeline settings), without a capacity the counts are exact. Returns a
+    tuple of (file name, number of entities or None on errors, stats).
+    '''
+    raw_file_path, file_name, shards, capacity, settings = task
+    entity_counts = Counter() if capacity is None else SpaceSaving(capacity)
+    docs, line_number = 0, 0
+    start = time.perf_counter()
+
+    try:
+        # We need to process the files using the pipe() to batch chunks,
+        # otherwise it gets loaded into memory and with an average size
+        # of 100mb combined with the already high memory usage of spacy
+        # this is way too much.
+        with open(raw_file_path, 'r', encoding='utf8') as f:
+            texts = group_lines(f, file_name, settings['lines_per_doc'])
+
+            for doc, (_, line_number) in nlp.pipe(
+                texts,
+                as_tuples=True,
+                batch_size=settings['batch_size'],
+                n_process=settings['n_process'],
+            ):
+                docs += 1
+
+                for entity in doc.ents:
+                    if capacity is None:
+                        entity_counts[entity.text.lower()] += 1
+                    else:
+                        entity_counts.update(entity.text.lower())
+    except MemoryError:
+        # I experienced some memory errors occasionally, the file
+        # is not marked as done so a rerun tries it again.
+        print(f'Memory error in {file_name} around line {line_number}')
+        return (file_name, None, None)
+
+    stats = {'docs': docs, 'seconds': time.perf_counter() - start}
+
+    tmp_path = f'{shard_path(shards, file_name)}.tmp'
+
+    with open(tmp_path, 'wb') as o:
+        pickle.dump(entity_counts, o)
+
+    os.replace(tmp_path, shard_path(shards, file_name))
+
+    found = len(entity_counts.keys()) if capacity is None \
+        else entity_counts.distinct.estimate()
+
+    return (file_name, found, stats)
 
 
 def main():
     try:
-        folder_path = sys.argv[1]
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            "path",
+            help="Path to the folder with raw corpus files"
+        )
+        parser.add_argument(
+            "-p",
+            "--processes",
+            type=int,
+            default=max(cpu_count() - 1, 1),
+            help="Number of files that are counted at the same time, \
+                  every process loads its own spacy model"
+        )
+        parser.add_argument(
+            "-a",
+            "--approximate",
+            type=int,
+            default=None,
+            metavar="CAPACITY",
+            help="Only keep (about) the <capacity> most common entities, \
+                  this uses a fixed amount of memory"
+        )
+        parser.add_argument(
+            "-l",
+            "--lines-per-doc",
+            type=int,
+            default=1,
+            help="Number of lines that are combined into one spacy doc, \
+                  default is 1"
+        )
+        parser.add_argument(
+            "-b",
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Batch size used by spacy, default is 1000"
+        )
+        parser.add_argument(
+            "-n",
+            "--n-process",
+            type=int,
+            default=1,
+            help="Number of processes spacy uses per file, only possible \
+                  with --processes 1"
+        )
+        args = parser.parse_args()
+
+        if args.n_process > 1 and args.processes > 1:
+            parser.error('--n-process only works with --processes 1')
     except ValueError:
         print(__doc__)
         exit()
 
-    # I experienced some memory errors occasionally
-    # this can help with manually trying again without
-    # repeating the same file.
-    # seen = set([
-    #     '0.txt',
-    #     '1.txt',
-    #     '2.txt',
-    #     '3.txt',
-    #     '4.txt',
-    #     '5.txt',
-    #     '6.txt',
-    #     '7.txt',
-    #     '8.txt',
-    #     '9.txt',
-    #     '10.txt',
-    #     '11.txt',
-    #     '12.txt',
-    #     '13.txt',
-    #     '14.txt',
-    #     '15.txt',
-    #     '16.txt',
-    #     '17.txt',
-    #     '18.txt',
-    #     '19.txt',
-    # ])
-    seen = set()
+    capacity = args.approximate
+
+    # Exact and approximate counts can not be merged, so they each
+    # get their own shards
+    if capacity is None:
+        shards = Config.ENTITY_COUNT_SHARDS
+        output = Config.ENTITY_COUNTS_PICKLE
+    else:
+        shards = Config.ENTITY_SKETCH_SHARDS
+        output = Config.ENTITY_COUNTS_SKETCH
+
+    os.makedirs(shards, exist_ok=True)
+
+    done = load_manifest(shards)
 
     total_files = [
-        x for x in list(os.scandir(folder_path))
+        x for x in list(os.scandir(args.path))
         if x.is_file() and
-        x.path.endswith('.txt') and
-        x.name not in seen
+        x.path.endswith('.txt')
+    ]
+    file_stats = {x.name: file_stat(x) for x in total_files}
+
+    # Old manifests do not have the stat, we assume those did not change
+    legacy = [
+        name for name, stat in done.items()
+        if stat is None and name in file_stats
+    ]
+
+    done.update({name: file_stats[name] for name in legacy})
+
+    # Until everything is merged again, the counts pickle is the only
+    # complete count of the corpus
+    save_manifest(shards, done)
+
+    # Files that changed since they were counted are counted again
+    todo = [
+        x for x in total_files
+        if done.get(x.name) != file_stats[x.name]
     ]
-    total_files_count = len(total_files)
 
     print(
-        f'Found {total_files_count} text \
-        files: {[x.name for x in total_files]}'
+        f'Found {len(total_files)} text files, \
+        {len(total_files) - len(todo)} already counted, \
+        still to do: {[x.name for x in todo]}'
     )
 
-    print('Loading spacy...')
+    settings = {
+        'lines_per_doc': args.lines_per_doc,
+        'batch_size': args.batch_size,
+        'n_process': args.n_process,
+    }
+    tasks = [(x.path, x.name, shards, capacity, settings) for x in todo]
+    speeds = []
 
-    # We only need the NER tagger, with everything enabled it is much slower
-    nlp = spacy.load(Config.SPACY_MODEL, disable=['parser', 'tagger'])
+    # Because this process takes a long time (about 1.5 hours on
+    # a 6 core 12 thread 16GB machine) we save the progress per file,
+    # so if something goes wrong, we have not lost all progress.
+    # Every worker is replaced after a file to free up its memory.
+    # Pool workers can not start processes, so with one process
+    # everything happens here (and spacy can use multiple processes).
+    if args.processes == 1:
+        load_nlp()
+        pool = None
+        results = map(count_file, tasks)
+    else:
+        pool = Pool(args.processes, initializer=load_nlp, maxtasksperchild=1)
+        results = pool.imap_unordered(count_file, tasks)
+
+    # The manifest is updated as soon as a file is done
+    for name, found, stats in results:
+        if found is None:
+            print(f'Memory error while counting {name}, skipped')
+            continue
 
-    entity_counts = Counter()
+        # The stat from before counting, if the file changed in the
+        # meantime it is counted again next time
+        done[name] = file_stats[name]
+        save_manifest(shards, done)
 
-    if not os.path.isfile(Config.ENTITY_COUNTS_PICKLE):
-        with open(Config.ENTITY_COUNTS_PICKLE, 'wb') as f:
-            pickle.dump(entity_counts, f)
+        speed = stats['docs'] / max(stats['seconds'], 1e-9)
+        speeds.append(speed)
 
-    for i, raw_file in enumerate(total_files):
         print(
-            f'Counting entities in file {raw_file.name} \
-            ({i + 1} / {total_files_count})'
+            f'Counted {found} entities in {name}, {stats["docs"]} docs \
+            in {stats["seconds"]:.1f}s ({speed:.1f} docs/s)'
         )
-        # Because this process takes a long time (about 1.5 hours on
-        # a 6 core 12 thread 16GB machine) we save the progress per file,
-        # so if something goes wrong, we have not lost all progress.
-        with open(Config.ENTITY_COUNTS_PICKLE, 'rb') as o:
-            entity_counts = pickle.load(o)
 
-        # We need to process the files using the pipe() to batch chunks,
-        # otherwise it gets loaded into memory and with an average size
-        # of 100mb combined with the already high memory usage of spacy
-        # this is way too much.
-        with open(raw_file.path, 'r', encoding='utf8') as f:
-            for j, doc in enumerate(nlp.pipe(f, n_process=cpu_count() - 1)):
-                for entity in doc.ents:
-                    entity_counts[entity.text.lower()] += 1
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-                j % 500 == 0 and print(f'Processing line {j}', end='\r')
+    if len(speeds) > 0:
+        print(
+            f'Average of {sum(speeds) / len(speeds):.1f} docs/s per process \
+            ({args.processes} processes, {args.lines_per_doc} lines per \
+            doc, batch size {args.batch_size})'
+        )
+
+    failed = [
+        x.name for x in todo
+        if done.get(x.name) != file_stats[x.name]
+    ]
+
+    if len(failed) > 0:
+        print(f'Not all files are counted, run again for: {failed}')
+        return
 
-        print(f'\rFound {len(entity_counts.keys())} so far')
+    # The manifest can contain files that are no longer in the folder
+    merged = sorted(x.name for x in total_files)
+    entity_counts = merge_shards(shards, merged, capacity)
 
-        with open(Config.ENTITY_COUNTS_PICKLE, 'wb') as o:
-            pickle.dump(entity_counts, o)
+    with open(output, 'wb') as o:
+        pickle.dump(entity_counts, o)
 
-        # This again just helps with the occasional crashes
-        seen.add(raw_file.name)
-        print(f'Seen files: {seen}')
+    # The other scripts use the same shards as the pickle
+    save_manifest(shards, done, merged)
+
+    if capacity is None:
+        print(
+            f'Counted all entities in corpus, totalling \
+            {len(entity_counts.keys())}'
+        )
+        return
 
     print(
-        f'Counted all entities in corpus, totalling \
-        {len(entity_counts.keys())}'
+        f'Counted the top {len(entity_counts.counts)} entities in corpus, \
+        about {entity_counts.distinct.estimate()} in total. Counts are at \
+        most {entity_counts.error_bound():.1f} too high.'
     )
 
 
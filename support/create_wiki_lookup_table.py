@@ -11,47 +11,216 @@ Description:    This script creates an efficient cache for looking up
 
                 See 'Links to Wikipedia Article'. This is either a txt or csv.
 
-Usage:          python create_wiki_lookup_table.py
+                The lookup table is a compact file (see 'frozen_table.py')
+                where the DBpedia and Wikipedia prefixes are stripped from
+                the keys and values. An old pickled lookup table can be
+                converted with --from-pickle.
+
+                The dump is read in parts by multiple processes, every
+                process writes its part to a shard file. The shards are
+                combined into the table, so the whole dump is never in
+                memory. With --update the entries of a (newer) dump are
+                added to the existing table, new links replace old ones.
+
+Usage:          python create_wiki_lookup_table.py [<path_to_dump>]
+                    [--processes <n>] [--update] [--from-pickle]
 '''
 
 
+import argparse
 import csv
+import os
 import pickle
 import sys
+import tempfile
+from itertools import chain
+from multiprocessing import Pool, cpu_count
 
 from config import Config
+from frozen_table import FrozenTable, write_table
 
 
-def main():
-    filepath = Config.DBPEDIA_TO_WIKI
+def strip_uri(uri, prefix):
+    ''' Removes the brackets and the given prefix from an uri '''
+    uri = uri.strip('<>')
+
+    if uri.startswith(prefix):
+        return uri[len(prefix):]
+    return uri
+
+
+def compact(lookup):
+    ''' Yields the lookup items with the prefixes stripped '''
+    for resource, link in lookup.items():
+        yield (
+            strip_uri(resource, Config.DBPEDIA_RESOURCE_PREFIX),
+            strip_uri(link, Config.WIKI_PAGE_PREFIX),
+        )
 
-    lookup = {}
 
+def parse_line(line, is_csv):
+    '''
+    Returns a (resource, link) tuple of a line of the dump
+    or None if the line does not contain a link.
+    '''
     # The first column in the csv is the resource string,
     # the second the Wikipedia origin
     # the third is the link to that entity
-    if filepath.endswith('.csv'):
-        with open(filepath, 'r') as f:
-            reader = csv.reader(f, delimiter='\t')
-            for row in reader:
-                lookup[row[0]] = row[2]
+    if is_csv:
+        row = next(csv.reader([line], delimiter='\t'), [])
 
     # The first 'column' in textfile is the resource string,
     # the second the Wikipedia origin (which I assume is always wikipage-nl)
     # the third is the link to that entity
-    if filepath.endswith('.txt'):
-        with open(filepath, 'r', encoding='utf8') as f:
-            for line in f.readlines():
-                row = line.strip().split()
-                row[0] = row[0].replace('<http://', '<http://nl.')
-                lookup[row[0]] = row[2]
+    else:
+        if line.startswith('#'):
+            return None
+
+        row = line.strip().split()
+
+        if len(row) > 0:
+            row[0] = row[0].replace('<http://dbpedia', '<http://nl.dbpedia')
+
+    if len(row) < 3:
+        return None
+
+    return (
+        strip_uri(row[0], Config.DBPEDIA_RESOURCE_PREFIX),
+        strip_uri(row[2], Config.WIKI_PAGE_PREFIX),
+    )
+
+
+def split_file(filepath, parts):
+    '''
+    Splits a file in (start, end) byte ranges of about the same
+    size that always start at the beginning of a line.
+    '''
+    size = os.path.getsize(filepath)
+    starts = [0]
+
+    with open(filepath, 'rb') as f:
+        for i in range(1, parts):
+            f.seek(max(size * i // parts, starts[-1]))
+            f.readline()
+            starts.append(min(f.tell(), size))
+
+    ends = starts[1:] + [size]
+
+    return [(s, e) for s, e in zip(starts, ends) if s < e]
+
+
+def parse_part(filepath, start, end, shard_path):
+    '''
+    Parses the lines in the byte range of the dump and writes the
+    links as tab separated lines to a shard file. Returns the number
+    of links found.
+    '''
+    is_csv = filepath.endswith('.csv')
+    found = 0
+
+    with open(filepath, 'rb') as f, \
+            open(shard_path, 'w', encoding='utf8') as o:
+        f.seek(start)
+        position = start
+
+        while position < end:
+            line = f.readline()
+
+            if not line:
+                break
+
+            position += len(line)
+            item = parse_line(line.decode('utf8'), is_csv)
+
+            if item is not None:
+                o.write(f'{item[0]}\t{item[1]}\n')
+                found += 1
+
+    return found
+
+
+def read_shards(shard_paths):
+    ''' Yields the (resource, link) tuples from the shards in order '''
+    for shard_path in shard_paths:
+        with open(shard_path, 'r', encoding='utf8') as f:
+            for line in f:
+                yield tuple(line.rstrip('\n').split('\t', 1))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "path",
+        nargs="?",
+        default=str(Config.DBPEDIA_TO_WIKI),
+        help="Path to the DBpedia dump (txt or csv), default is \
+              DBPEDIA_TO_WIKI from the config"
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=cpu_count(),
+        help="Number of processes that parse the dump"
+    )
+    parser.add_argument(
+        "--update",
+        help="Add the links to the existing lookup table instead \
+              of creating a new one",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--from-pickle",
+        help="Convert the old pickled lookup table instead of \
+              reading the DBpedia file",
+        action="store_true"
+    )
+    args = parser.parse_args()
+
+    if args.from_pickle:
+        with open(Config.WIKI_LOOKUP_PICKLE, 'rb') as f:
+            lookup = pickle.load(f)
+
+        total = write_table(Config.WIKI_LOOKUP_TABLE, compact(lookup))
+        print(f'Converted lookup table with {total} entries')
+        return
+
+    if not args.path.endswith(('.txt', '.csv')):
+        print(__doc__)
+        exit()
+
+    with tempfile.TemporaryDirectory(dir=Config.DATA_FOLDER) as shard_dir:
+        parts = split_file(args.path, args.processes)
+        shard_paths = [
+            os.path.join(shard_dir, f'{i}.tsv') for i in range(len(parts))
+        ]
+
+        print(f'Parsing {args.path} in {len(parts)} parts...')
+
+        with Pool(args.processes) as pool:
+            found = pool.starmap(parse_part, [
+                (args.path, start, end, shard_path)
+                for (start, end), shard_path in zip(parts, shard_paths)
+            ])
+
+        print(f'Found {sum(found)} links')
+
+        items = read_shards(shard_paths)
+        existing = None
+
+        # The existing entries go first, so the new links win
+        if args.update and os.path.isfile(Config.WIKI_LOOKUP_TABLE):
+            existing = FrozenTable(Config.WIKI_LOOKUP_TABLE)
+            items = chain(existing.items(), items)
+
+        total = write_table(Config.WIKI_LOOKUP_TABLE, items)
 
-    with open(Config.WIKI_LOOKUP_PICKLE, 'wb') as o:
-        pickle.dump(lookup, o)
+        if existing is not None:
+            existing.close()
 
     print(
         f'Created DBPedia to Wikipedia lookup table with \
-        {len(lookup)} entries'
+        {total} entries'
     )
 
 
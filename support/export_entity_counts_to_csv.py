@@ -6,26 +6,141 @@ Date:           19-11-2020
 Description:    Creates a sorted csv of all entity counts
                 to see what is going on.
 
-Usage:          python export_entity_counts_to_csv.py
+                The counts are read from the count shards that the last
+                complete run of 'create_entity_count.py' merged or,
+                without those, from ENTITY_COUNTS_PICKLE. Sorting happens on disk (external
+                merge sort), only <run-size> counts are sorted in memory
+                at a time:
+                    1. every shard is sorted by entity into a run file
+                    2. the runs are merged and the counts of the same
+                       entity are added up
+                    3. these totals are sorted by count in runs again
+                    4. the runs are merged while writing the csv
+
+                With --top <n> only the <n> most common entities are
+                written, these are selected with a heap of size <n>.
+
+Usage:          python export_entity_counts_to_csv.py [--top <n>]
+                    [--run-size <n>]
 '''
 
 
+import argparse
 import csv
+import heapq
+import json
 import os
 import pickle
 import sys
-from collections import Counter
+import tempfile
+from itertools import groupby, islice
+from operator import itemgetter
 
 from config import Config
+from count_shards import load_merged, shard_path
 
 
-def main():
+def write_run(path, items):
+    ''' Writes (entity, count) tuples as one JSON list per line '''
+    with open(path, 'w', encoding='utf8') as f:
+        f.writelines(f'{json.dumps(item)}\n' for item in items)
+
+
+def read_run(path):
+    with open(path, 'r', encoding='utf8') as f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+
+def by_count(item):
+    # Most common first, the same counts in alphabetical order
+    return (-item[1], item[0])
+
+
+def entity_totals(tmp_dir):
+    '''
+    Yields the (entity, total count) tuples of the merged count shards in
+    alphabetical order. Only one shard is in memory at a time.
+    '''
+    names = sorted(load_merged(Config.ENTITY_COUNT_SHARDS))
+    run_paths = []
+
+    for i, name in enumerate(names):
+        with open(shard_path(Config.ENTITY_COUNT_SHARDS, name), 'rb') as f:
+            shard = pickle.load(f)
+
+        run_paths.append(os.path.join(tmp_dir, f'entities_{i}.jsonl'))
+        write_run(run_paths[-1], sorted(shard.items()))
+        del shard
+
+    merged = heapq.merge(*[read_run(path) for path in run_paths])
+
+    for entity, items in groupby(merged, key=itemgetter(0)):
+        yield entity, sum(count for _, count in items)
+
+
+def load_counts():
+    '''
+    Returns the Counter of ENTITY_COUNTS_PICKLE or None when the shards
+    are merged by a complete count run, those are read one by one in
+    'entity_totals'. An unfinished run only has some of the shards.
+    '''
+    if len(load_merged(Config.ENTITY_COUNT_SHARDS)) > 0:
+        return None
+
     # The entity counts file consists of a Counter
     # which means tuples of (<entity string>, <count>)
     with open(Config.ENTITY_COUNTS_PICKLE, 'rb') as f:
-        entity_counts = pickle.load(f)
+        return pickle.load(f)
+
+
+def sort_by_count(items, tmp_dir, run_size):
+    ''' Sorts (entity, count) tuples by count using runs on disk '''
+    run_paths = []
+
+    for i, run in enumerate(iter(lambda: list(islice(items, run_size)), [])):
+        run.sort(key=by_count)
+        run_paths.append(os.path.join(tmp_dir, f'counts_{i}.jsonl'))
+        write_run(run_paths[-1], run)
+        del run
+
+    return heapq.merge(*[read_run(path) for path in run_paths], key=by_count)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n",
+        "--top",
+        type=int,
+        default=None,
+        help="Only export the <n> most common entities"
+    )
+    parser.add_argument(
+        "-r",
+        "--run-size",
+        type=int,
+        default=1000000,
+        help="Number of counts that are sorted in memory at a time, \
+              default is 1000000"
+    )
+    args = parser.parse_args()
+
+    entity_counts = load_counts()
+    rows = 0
+
+    with tempfile.TemporaryDirectory(dir=Config.DATA_FOLDER) as tmp_dir, \
+            open(Config.ENTITY_COUNTS_CSV, 'w') as csvfile:
+        if entity_counts is None:
+            items = entity_totals(tmp_dir)
+        else:
+            items = iter(entity_counts.items())
+
+        if args.top is not None:
+            top_counts = heapq.nsmallest(args.top, items, key=by_count)
+        else:
+            top_counts = sort_by_count(items, tmp_dir, args.run_size)
 
-    with open(Config.ENTITY_COUNTS_CSV, 'w') as csvfile:
         writer = csv.writer(csvfile,
                             delimiter=',',
                             quoting=csv.QUOTE_MINIMAL)
@@ -33,10 +148,11 @@ def main():
         # Header row
         writer.writerow(['entity', 'count'])
 
-        for entity in entity_counts.most_common(len(entity_counts)):
-            writer.writerow([entity[0], entity[1]])
+        for entity, count in top_counts:
+            writer.writerow([entity, count])
+            rows += 1
 
-    print(f'Created csv with {len(entity_counts)} rows')
+    print(f'Created csv with {rows} rows')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,194 @@
+'''
+File name:      frozen_table.py
+Date:           17-10-2026
+Description:    A compact, read-only string to string table stored in
+                a single file. The file is opened with mmap, so a lookup
+                only reads the pages it needs and multiple processes that
+                open the same file share the same memory.
+
+                Layout of the file:
+                    header:  magic, version, number of items and slots
+                    slots:   open addressing hash table of record offsets
+                    records: <key length><value length><key><value>
+
+                The slots are stored in the native byte order, so the
+                file should be created on the same kind of machine.
+
+                Used for the DBpedia to Wikipedia lookup table and the
+                entity blacklist (only keys, for membership tests).
+'''
+
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from array import array
+
+MAGIC = b'FRZT'
+VERSION = 1
+HEADER = struct.Struct('<4sIQQ')
+RECORD = struct.Struct('<II')
+
+
+def _key_at(records, offset):
+    ''' Returns the key of the record at the given offset '''
+    key_length, _ = RECORD.unpack_from(records, offset)
+    start = offset + RECORD.size
+    return records[start:start + key_length]
+
+
+def write_table(path, items):
+    '''
+    Writes an iterable of (key, value) strings to a table file. The value
+    can be None, then the table can only be used for membership tests.
+    If a key occurs multiple times, the last value is used. Only the
+    offsets and hashes are kept in memory, not the strings themselves.
+    Returns the number of unique keys.
+    '''
+    hashes = array('I')
+    offsets = array('Q')
+
+    with tempfile.TemporaryFile(dir=os.path.dirname(str(path)) or '.') as r:
+        position = 0
+
+        for key, value in items:
+            key = key.encode('utf8')
+            value = b'' if value is None else value.encode('utf8')
+
+            r.write(RECORD.pack(len(key), len(value)))
+            r.write(key)
+            r.write(value)
+
+            hashes.append(zlib.crc32(key))
+            offsets.append(position)
+            position += RECORD.size + len(key) + len(value)
+
+        r.flush()
+
+        # At most half of the slots are used, this keeps the probe
+        # sequences short. The size is a power of two for fast masking.
+        n_slots = 1
+        while n_slots < len(offsets) * 2:
+            n_slots *= 2
+
+        mask = n_slots - 1
+        slots = array('Q', bytes(8 * n_slots))
+        n_items = 0
+
+        records = mmap.mmap(r.fileno(), 0, access=mmap.ACCESS_READ) \
+            if position > 0 else b''
+
+        for key_hash, offset in zip(hashes, offsets):
+            i = key_hash & mask
+
+            # Slots store the offset + 1, so 0 means empty
+            while slots[i]:
+                if _key_at(records, slots[i] - 1) == _key_at(records, offset):
+                    slots[i] = offset + 1
+                    break
+
+                i = (i + 1) & mask
+            else:
+                slots[i] = offset + 1
+                n_items += 1
+
+        if position > 0:
+            records.close()
+
+        # Write to a temporary file first, so a crash does not leave a
+        # half written table behind.
+        r.seek(0)
+        with open(f'{path}.tmp', 'wb') as o:
+            o.write(HEADER.pack(MAGIC, VERSION, n_items, n_slots))
+            o.write(slots.tobytes())
+            shutil.copyfileobj(r, o)
+
+    os.replace(f'{path}.tmp', path)
+
+    return n_items
+
+
+class FrozenTable():
+    '''
+    Read-only view on a table file created with 'write_table'.
+    Behaves like a (read-only) dictionary with string keys and values.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.n_items, self.n_slots = \
+            HEADER.unpack_from(self.mm, 0)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a valid table file')
+
+        self.mask = self.n_slots - 1
+        self.records_start = HEADER.size + 8 * self.n_slots
+
+        # A view on the slots directly in the mapped file, this way
+        # nothing is copied into memory.
+        self.slots = memoryview(self.mm)[HEADER.size:self.records_start] \
+            .cast('Q')
+
+    def __find(self, key):
+        ''' Returns the file offset of the record with the key or -1 '''
+        key = key.encode('utf8')
+        i = zlib.crc32(key) & self.mask
+
+        while True:
+            slot = self.slots[i]
+
+            if slot == 0:
+                return -1
+
+            offset = self.records_start + slot - 1
+
+            if _key_at(self.mm, offset) == key:
+                return offset
+
+            i = (i + 1) & self.mask
+
+    def __value_at(self, offset):
+        key_length, value_length = RECORD.unpack_from(self.mm, offset)
+        start = offset + RECORD.size + key_length
+        return self.mm[start:start + value_length].decode('utf8')
+
+    def __contains__(self, key):
+        return self.__find(key) != -1
+
+    def __getitem__(self, key):
+        offset = self.__find(key)
+
+        if offset == -1:
+            raise KeyError(key)
+
+        return self.__value_at(offset)
+
+    def __len__(self):
+        return self.n_items
+
+    def __iter__(self):
+        return (key for key, _ in self.items())
+
+    def get(self, key, default=None):
+        offset = self.__find(key)
+        return default if offset == -1 else self.__value_at(offset)
+
+    def items(self):
+        for slot in self.slots:
+            if slot == 0:
+                continue
+
+            offset = self.records_start + slot - 1
+            key = _key_at(self.mm, offset).decode('utf8')
+            yield key, self.__value_at(offset)
+
+    def close(self):
+        self.slots.release()
+        self.mm.close()
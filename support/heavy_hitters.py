@@ -0,0 +1,155 @@
+'''
+File name:      heavy_hitters.py
+Date:           17-10-2026
+Description:    Approximate counting of the most frequent items in a
+                stream using a fixed amount of memory. Used by
+                'create_entity_count.py' with --approximate, because
+                the blacklist only needs the most common entities and
+                most entities only occur once.
+
+                SpaceSaving keeps at most <capacity> counters. Counts are
+                never too low and at most <total / capacity> too high, the
+                'error' of an item is its own (smaller) upper bound.
+                DistinctCounter estimates the number of unique items
+                (k minimum values), which is needed for a percentage cutoff.
+'''
+
+import hashlib
+import heapq
+
+
+class DistinctCounter():
+    ''' Estimates the number of distinct items using the k smallest hashes '''
+
+    def __init__(self, k=4096):
+        self.k = k
+        # Max heap (negated values) of the k smallest hashes
+        self.heap = []
+        self.seen = set()
+
+    @staticmethod
+    def __hash(item):
+        digest = hashlib.blake2b(item.encode('utf8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def add(self, item):
+        self.__add_hash(self.__hash(item))
+
+    def __add_hash(self, value):
+        if value in self.seen:
+            return
+
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, -value)
+            self.seen.add(value)
+        elif value < -self.heap[0]:
+            self.seen.discard(-heapq.heappushpop(self.heap, -value))
+            self.seen.add(value)
+
+    def merge(self, other):
+        for value in other.seen:
+            self.__add_hash(value)
+
+    def estimate(self):
+        # Less than k unique items means we have seen all of them
+        if len(self.heap) < self.k:
+            return len(self.heap)
+
+        return int((self.k - 1) * 2 ** 64 / -self.heap[0])
+
+
+class SpaceSaving():
+    ''' Space-Saving heavy hitters summary with a fixed number of counters '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        self.distinct = DistinctCounter()
+
+        # Min heap of (count, item), old entries are skipped when popped
+        self.heap = []
+
+    def update(self, item, count=1):
+        self.total += count
+        self.distinct.add(item)
+
+        if item in self.counts:
+            self.counts[item] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+        else:
+            # The new item replaces the one with the lowest count, that
+            # count is the most the new item could have been missed.
+            min_count, min_item = self.__pop_min()
+            del self.counts[min_item]
+            del self.errors[min_item]
+
+            self.counts[item] = min_count + count
+            self.errors[item] = min_count
+
+        heapq.heappush(self.heap, (self.counts[item], item))
+
+        if len(self.heap) > 4 * self.capacity:
+            self.__rebuild_heap()
+
+    def merge(self, other):
+        '''
+        Adds the counts of another summary. An item that is missing from
+        a full summary occurred at most as often as its lowest count.
+        '''
+        own_min = self.__min_count()
+        other_min = other.__min_count()
+
+        merged = {}
+
+        for item in set(self.counts) | set(other.counts):
+            merged[item] = (
+                self.counts.get(item, own_min) +
+                other.counts.get(item, other_min),
+                self.errors.get(item, own_min) +
+                other.errors.get(item, other_min),
+            )
+
+        top = heapq.nlargest(
+            self.capacity,
+            merged.items(),
+            key=lambda x: x[1][0]
+        )
+
+        self.counts = {item: count for item, (count, _) in top}
+        self.errors = {item: error for item, (_, error) in top}
+        self.total += other.total
+        self.distinct.merge(other.distinct)
+        self.__rebuild_heap()
+
+    def most_common(self, n=None):
+        ''' Returns a list of (item, count, error) tuples, highest first '''
+        n = len(self.counts) if n is None else n
+        top = heapq.nlargest(n, self.counts.items(), key=lambda x: x[1])
+        return [(item, count, self.errors[item]) for item, count in top]
+
+    def error_bound(self):
+        ''' No count is more than this too high '''
+        return self.total / self.capacity
+
+    def __min_count(self):
+        if len(self.counts) < self.capacity:
+            return 0
+
+        min_count, min_item = self.__pop_min()
+        heapq.heappush(self.heap, (min_count, min_item))
+        return min_count
+
+    def __pop_min(self):
+        while True:
+            count, item = heapq.heappop(self.heap)
+
+            if self.counts.get(item) == count:
+                return count, item
+
+    def __rebuild_heap(self):
+        self.heap = [(count, item) for item, count in self.counts.items()]
+        heapq.heapify(self.heap)
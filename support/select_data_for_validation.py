@@ -10,17 +10,200 @@ Description:    Creates a selection of output from the
                 Warning: This will overwrite any db that is stored
                 in the data folder specified in config.py.
 
-Usage:          python select_data_for_validation.py
+                The output file is read line by line and the rows are
+                inserted in batches (--batch-size) in a single
+                transaction, which is a lot faster than adding them
+                one by one.
+
+                By default the first <target> items with and without an
+                explanation are selected. With --stratified a random
+                sample of <target> items is taken for every combination
+                of system decision and choice. The same --seed gives the
+                same sample.
+
+                With --columnar the entities table of 'main.py --format
+                parquet/arrow' is read instead of OUTPUT_RAW, only the
+                columns that are needed (see 'columnar.py').
+
+Usage:          python select_data_for_validation.py [--target <n>]
+                    [--stratified] [--seed <n>] [--batch-size <n>]
+                    [--columnar]
 '''
 
+import argparse
 import json
 import os
+import random
+from itertools import islice
 
 from api import ValidationModel, db
+from columnar import read_entity_documents
 from config import Config
 
+# The output lists need to be mapped to the label used in the validation
+DB_MAPPING = {'annotated_entities': 'with', 'ignored_entities': 'without'}
+
+# Only used during the load, the db is created from scratch anyway
+# so there is nothing to lose if it crashes.
+BULK_PRAGMAS = [
+    'PRAGMA synchronous = OFF',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -64000',
+]
+
+# The entity columns used in 'to_row'
+ROW_COLUMNS = [
+    'entity',
+    'extract',
+    'score',
+    'choice',
+    'context_with_explanation',
+    'context_highlighted',
+    'context_without_explanation',
+]
+
+
+def read_output(path):
+    ''' Yields the parsed documents of the output file one by one '''
+    with open(path, 'r') as output:
+        for line in output:
+            yield json.loads(line)
+
+
+def to_row(ann, decision):
+    ''' Maps an annotation to the columns of ValidationModel '''
+    return {
+        'entity': ann['entity'],
+        'extract': ann['extract'],
+        'score': ann['score'],
+        'with_explanation_raw': ann['context_with_explanation'],
+        'with_explanation': ann['context_highlighted'],
+        'without_explanation': ann['context_without_explanation'],
+        'system_decision': decision,
+        'system_choice': ann['choice'],
+    }
+
+
+def select_first(documents, target):
+    '''
+    Yields the rows in the same way as it was initially done, until
+    <target> items with and without explanation are found.
+    '''
+    with_explanation = 0
+    without_explanation = 0
+
+    for data in documents:
+        if with_explanation >= target and without_explanation >= target:
+            break
+
+        for key, decision in DB_MAPPING.items():
+            for ann in data[key]:
+                if (len(data['annotated_entities']) > 0
+                        and with_explanation < target):
+                    with_explanation += 1
+                    yield to_row(ann, decision)
+                    continue
+
+                if (len(data['ignored_entities']) > 0
+                        and without_explanation < target):
+                    without_explanation += 1
+                    yield to_row(ann, decision)
+
+
+def select_stratified(documents, target, seed):
+    '''
+    Returns a random sample of <target> rows for every combination of
+    system decision and choice. Reservoir sampling is used, so only the
+    samples are kept in memory. The rows keep the order of the file.
+    '''
+    rng = random.Random(seed)
+    reservoirs = {}
+    seen = {}
+    position = 0
+
+    for data in documents:
+        for key, decision in DB_MAPPING.items():
+            for ann in data[key]:
+                stratum = (decision, ann['choice'])
+                reservoir = reservoirs.setdefault(stratum, [])
+                seen[stratum] = seen.get(stratum, 0) + 1
+                position += 1
+
+                if len(reservoir) < target:
+                    reservoir.append((position, to_row(ann, decision)))
+                    continue
+
+                i = rng.randrange(seen[stratum])
+
+                if i < target:
+                    reservoir[i] = (position, to_row(ann, decision))
+
+    for stratum, reservoir in sorted(reservoirs.items()):
+        print(
+            f'Selected {len(reservoir)} of {seen[stratum]} items for \
+            {stratum[0]} / {stratum[1]}'
+        )
+
+    samples = [x for reservoir in reservoirs.values() for x in reservoir]
+
+    return [row for _, row in sorted(samples, key=lambda x: x[0])]
+
+
+def insert_rows(rows, batch_size):
+    ''' Inserts the rows in batches in a single transaction '''
+    table = ValidationModel.__table__
+    rows = iter(rows)
+    total = 0
+
+    with db.engine.connect() as conn:
+        for pragma in BULK_PRAGMAS:
+            conn.execute(pragma)
+
+        with conn.begin():
+            for batch in iter(lambda: list(islice(rows, batch_size)), []):
+                conn.execute(table.insert(), batch)
+                total += len(batch)
+
+    return total
+
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-t",
+        "--target",
+        type=int,
+        default=500,
+        help="Number of items with and without explanation, or per \
+              decision and choice with --stratified. Default is 500."
+    )
+    parser.add_argument(
+        "-s",
+        "--stratified",
+        help="Take a random sample per system decision and choice",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the stratified sample, default is 0"
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="Number of rows per insert, default is 1000"
+    )
+    parser.add_argument(
+        "-c",
+        "--columnar",
+        help="Read the columnar output in OUTPUT_COLUMNAR",
+        action="store_true"
+    )
+    args = parser.parse_args()
+
     # We are going to select:
     #   500 decided not to explain
     #   500 decided to explain
@@ -29,50 +212,23 @@ def main():
     # The final database contains a lot less, both to increase the chance
     # of two annotations for the same sample and because a lot more people
     # were needed to annotate this many!
-    target = 500
-    with_explanation = 0
-    without_explanation = 0
 
     # We are going to overwrite any existing db, so watch out!
     db.create_all()
 
-    # The output lists need to be mapped to the label used in the validation
-    db_mapping = {'annotated_entities': 'with', 'ignored_entities': 'without'}
+    if args.columnar:
+        documents = read_entity_documents(Config.OUTPUT_COLUMNAR, ROW_COLUMNS)
+    else:
+        documents = read_output(Config.OUTPUT_RAW)
 
-    with open(Config.OUTPUT_RAW, 'r') as output:
-        for line in output:
-            if with_explanation >= target and without_explanation >= target:
-                break
-
-            data = json.loads(line)
-
-            for key, decision in db_mapping.items():
-                for ann in data[key]:
-                    model = ValidationModel(
-                        entity=ann['entity'],
-                        extract=ann['extract'],
-                        score=ann['score'],
-                        with_explanation_raw=ann['context_with_explanation'],
-                        with_explanation=ann['context_highlighted'],
-                        without_explanation=ann['context_without_explanation'],
-                        system_decision=decision,
-                        system_choice=ann['choice'],
-                    )
-
-                    if (len(data['annotated_entities']) > 0
-                            and with_explanation < target):
-                        with_explanation += 1
-                        db.session.add(model)
-                        continue
-
-                    if (len(data['ignored_entities']) > 0
-                            and without_explanation < target):
-                        without_explanation += 1
-                        db.session.add(model)
-
-    db.session.commit()
-
-    print(f'Created sqlite db')
+    if args.stratified:
+        rows = select_stratified(documents, args.target, args.seed)
+    else:
+        rows = select_first(documents, args.target)
+
+    total = insert_rows(rows, args.batch_size)
+
+    print(f'Created sqlite db with {total} items')
 
 
 if __name__ == '__main__':
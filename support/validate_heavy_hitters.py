@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+'''
+File name:      validate_heavy_hitters.py
+Date:           17-10-2026
+Description:    Compares the approximate entity counts (see
+                'heavy_hitters.py') with exact counts on a sample
+                of a corpus file. This shows if the capacity used
+                with 'create_entity_count.py --approximate' is high
+                enough to find the blacklist entities.
+
+Usage:          python validate_heavy_hitters.py <path_to_raw_file>
+                    [--lines <n>] [--capacity <n>] [--top <n>]
+'''
+
+import argparse
+from collections import Counter
+from itertools import islice
+
+import spacy
+
+from config import Config
+from heavy_hitters import SpaceSaving
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "path",
+        help="Path to a raw corpus file"
+    )
+    parser.add_argument(
+        "-l",
+        "--lines",
+        type=int,
+        default=100000,
+        help="Number of lines of the file to use as sample"
+    )
+    parser.add_argument(
+        "-c",
+        "--capacity",
+        type=int,
+        default=10000,
+        help="Capacity of the approximate counter"
+    )
+    parser.add_argument(
+        "-t",
+        "--top",
+        type=int,
+        default=None,
+        help="Number of top entities to compare, default is the top 1%%"
+    )
+    args = parser.parse_args()
+
+    nlp = spacy.load(Config.SPACY_MODEL, disable=['parser', 'tagger'])
+
+    exact = Counter()
+    approximate = SpaceSaving(args.capacity)
+
+    with open(args.path, 'r', encoding='utf8') as f:
+        for doc in nlp.pipe(islice(f, args.lines)):
+            for entity in doc.ents:
+                exact[entity.text.lower()] += 1
+                approximate.update(entity.text.lower())
+
+    top = args.top or max(int(len(exact) * 0.01), 1)
+
+    exact_top = {e for e, _ in exact.most_common(top)}
+    approximate_top = {e for e, _, _ in approximate.most_common(top)}
+    found = len(exact_top & approximate_top)
+
+    max_error = max(
+        [count - exact[e] for e, count, _ in approximate.most_common()],
+        default=0
+    )
+
+    print(f'Entities in sample: {sum(exact.values())}')
+    print(
+        f'Unique entities: {len(exact)} exact, \
+        {approximate.distinct.estimate()} estimated'
+    )
+    print(f'Top {top} overlap: {found} ({found / top:.2%})')
+    print(
+        f'Largest count error: {max_error}, \
+        guaranteed bound: {approximate.error_bound():.1f}'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+'''
+File name:      test_scoring_parity.py
+Date:           17-10-2026
+Description:    Checks that the NumPy scoring in 'entity_linker.py' gives
+                the same scores as the old implementation, which parsed
+                the cleaned sentences again and used spacy's
+                'Doc.similarity'. Needs spacy with nl_core_news_lg, the
+                tests are skipped otherwise.
+
+Usage:          python -m pytest tests
+'''
+
+import pytest
+
+spacy = pytest.importorskip('spacy')
+
+from entity_linker import EntityLinker, EntityLinkerChoice  # noqa: E402
+from support.config import Config  # noqa: E402
+from utils import load_stop_words  # noqa: E402
+
+TRIPLES = [
+    # (entity, text with the entity, extract, explanation)
+    (
+        'Rutte',
+        'Het kabinet kwam vandaag bijeen in Den Haag. Premier Rutte '
+        'sprak over de begroting. De oppositie was niet tevreden.',
+        'Mark Rutte is een Nederlands politicus van de VVD.',
+        'minister-president van Nederland',
+    ),
+    (
+        'Ajax',
+        'Ajax won zondag met twee doelpunten verschil. De trainer was '
+        'blij met het spel van de ploeg.',
+        'Ajax is een voetbalclub uit Amsterdam.',
+        'voetbalclub uit Amsterdam',
+    ),
+    (
+        'Rijn',
+        'Het water in de Rijn staat erg hoog. Schepen mogen niet meer '
+        'varen.',
+        'De Rijn is een rivier in West-Europa.',
+        'rivier',
+    ),
+]
+
+
+@pytest.fixture(scope='module')
+def linker():
+    try:
+        nlp = spacy.load(Config.SPACY_MODEL, disable=['tagger', 'ner'])
+    except OSError:
+        pytest.skip(f'spacy model {Config.SPACY_MODEL} is not installed')
+
+    # Only what the scoring needs, not Spotlight or the lookup tables
+    e = EntityLinker.__new__(EntityLinker)
+    e.nlp = nlp
+    e.stop_words = load_stop_words()
+    e.entity_blacklist = set()
+
+    return e
+
+
+def old_clean_sentence(e, sentence, entity):
+    return e.nlp(
+        ' '.join([
+            w.text for w in sentence
+            if w.text.lower() not in e.stop_words
+            and w.text != entity
+            and w.has_vector
+        ])
+    )
+
+
+def old_score(e, entity, context, extract, explanation,
+              explanation_weight=0.7, extract_weight=0.3):
+    ''' 'get_is_needed_score' before the NumPy scoring '''
+    clean_sentences = [
+        old_clean_sentence(e, context[context_type], entity)
+        for context_type in ['left', 'sentence', 'right']
+        if len(context[context_type]) > 0
+    ]
+
+    extract = old_clean_sentence(e, extract, entity)
+    explanation = old_clean_sentence(e, explanation, entity)
+
+    explanation_sum = sum([
+        s.similarity(explanation)
+        for s in clean_sentences]) if len(explanation.text) > 0 else 0
+
+    extract_sum = sum([
+        s.similarity(extract)
+        for s in clean_sentences]) if len(extract.text) > 0 else 0
+
+    return (explanation_sum / len(clean_sentences)) * explanation_weight + \
+        (extract_sum / len(clean_sentences)) * extract_weight
+
+
+def new_score(e, entity, context, extract, explanation):
+    # The extract and explanation are cleaned once per entity without
+    # the entity, just like in '__annotate_doc'
+    score, choice = e.get_is_needed_score(
+        entity,
+        context,
+        e._EntityLinker__clean_sentence(extract, None),
+        e._EntityLinker__clean_sentence(explanation, None),
+    )
+
+    assert choice == EntityLinkerChoice.CONTEXT
+
+    return score
+
+
+def make_context(e, text, entity):
+    sents = list(e.nlp(text).sents)
+    i = next(i for i, s in enumerate(sents) if entity in s.text)
+    empty = e.nlp('')[:]
+
+    return {
+        'left': sents[i - 1] if i > 0 else empty,
+        'sentence': sents[i],
+        'right': sents[i + 1] if i + 1 < len(sents) else empty,
+    }
+
+
+@pytest.mark.parametrize('entity,text,extract,explanation', TRIPLES)
+def test_score_parity(linker, entity, text, extract, explanation):
+    context = make_context(linker, text, entity)
+    extract = linker.nlp(extract)
+    explanation = linker.nlp(explanation)
+
+    assert new_score(linker, entity, context, extract, explanation) == \
+        pytest.approx(
+            old_score(linker, entity, context, extract, explanation),
+            abs=1e-5
+        )
+
+
+def test_identical_words(linker):
+    sentence = linker.nlp('Rutte sprak over de begroting')
+    context = {
+        'left': sentence[:0],
+        'sentence': sentence,
+        'right': sentence[:0],
+    }
+
+    old = old_score(linker, 'Rutte', context, sentence, sentence)
+    new = new_score(linker, 'Rutte', context, sentence, sentence)
+
+    assert old == pytest.approx(1.0)
+    assert new == pytest.approx(old)
+
+
+def test_empty_clean_sentence(linker):
+    # Only stop words and the entity, nothing is left after cleaning
+    sentence = linker.nlp('Rutte is er ook')
+    extract = linker.nlp('Mark Rutte is een Nederlands politicus.')
+    explanation = linker.nlp('minister-president van Nederland')
+    context = {
+        'left': sentence[:0],
+        'sentence': sentence,
+        'right': sentence[:0],
+    }
+
+    clean = linker._EntityLinker__clean_sentence(sentence, 'Rutte')
+    assert len(clean[0]) == 0
+
+    assert new_score(linker, 'Rutte', context, extract, explanation) == \
+        pytest.approx(
+            old_score(linker, 'Rutte', context, extract, explanation),
+            abs=1e-5
+        )
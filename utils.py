@@ -1,11 +1,75 @@
 import os
 import pickle
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cache import CACHE_BACKENDS, EmbeddingCache, migrate_pickle_cache
 from support.config import Config
+from support.frozen_table import FrozenTable
+
+
+def insert_many(in_string, insertions):
+    '''
+    Inserts multiple strings at once, 'insertions' is a list of
+    (index, to_be_inserted) tuples with indices of the original string.
+    Strings with the same index are inserted in the given order.
+    '''
+    parts = []
+    previous = 0
+
+    for i, to_be_inserted in sorted(insertions, key=lambda x: x[0]):
+        parts.append(in_string[previous:i])
+        parts.append(to_be_inserted)
+        previous = i
+
+    parts.append(in_string[previous:])
+
+    return ''.join(parts)
+
+
+def read_corpus(path, chunk_size=1 << 20):
+    '''
+    Yields the documents of a raw DutchWebCorpus txt file one by one.
+    This gives the same documents as splitting the whole file on empty
+    lines, but only the current chunk is kept in memory.
+    '''
+    with open(path, 'r', encoding='utf8') as f:
+        buffer = ''
 
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            # The last part might be an incomplete document,
+            # so that one is kept for the next chunk.
+            *documents, buffer = (buffer + chunk).split('\n\n')
 
-def insert(in_string, to_be_inserted, i):
-    return f'{in_string[:i]}{to_be_inserted}{in_string[i:]}'
+            for document in documents:
+                yield document.replace('\n', ' ')
+
+        yield buffer.replace('\n', ' ')
+
+
+def count_documents(path, chunk_size=1 << 20):
+    '''
+    Returns the number of documents 'read_corpus' yields for a file,
+    without keeping the documents or their offsets. The file is read in
+    the same way (text mode), so other line endings count the same.
+    '''
+    count = 1
+
+    with open(path, 'r', encoding='utf8') as f:
+        # Newlines at the end of a chunk could be part of a separator
+        newlines = ''
+
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            text = newlines + chunk
+            end = len(text.rstrip('\n'))
+            newlines = text[end:]
+            count += text.count('\n\n', 0, end)
+
+        count += newlines.count('\n\n')
+
+    return count
 
 
 def load_stop_words(path=Config.STOP_WORDS_RAW):
@@ -21,35 +85,87 @@ def load_stop_words(path=Config.STOP_WORDS_RAW):
     return stop_words
 
 
-def load_entity_blacklist(path=Config.ENTITY_BLACKLIST_PICKLE):
-    if not os.path.isfile(path):
+def load_entity_blacklist(
+    path=Config.ENTITY_BLACKLIST_TABLE,
+    legacy_path=Config.ENTITY_BLACKLIST_PICKLE,
+):
+    # The memory mapped table is shared between processes, an old
+    # blacklist only exists as pickled set
+    if os.path.isfile(path):
+        return FrozenTable(path)
+
+    if not os.path.isfile(legacy_path):
         raise FileNotFoundError(
             f"Entity blacklist not found at {path}"
         )
 
-    with open(path, 'rb') as f:
+    with open(legacy_path, 'rb') as f:
         blacklist = pickle.load(f)
     return blacklist
 
 
-def load_or_create_expl_cache(path=Config.EXPLANATION_CACHE):
-    # Create an empty cache if it is not present
-    if not os.path.isfile(path):
+def load_or_create_expl_cache(
+    path=Config.EXPLANATION_CACHE_DB,
+    backend=Config.EXPLANATION_CACHE_BACKEND,
+    legacy_path=Config.EXPLANATION_CACHE,
+):
+    if backend not in CACHE_BACKENDS:
+        raise ValueError(
+            f"Unknown explanation cache backend '{backend}', \
+            choose from {list(CACHE_BACKENDS.keys())}"
+        )
+
+    if backend == 'pickle':
+        path = legacy_path
+
+    # An empty cache is created if it is not present
+    cache = CACHE_BACKENDS[backend](path)
+
+    # The sqlite file can already exist without the migration being done,
+    # for example when it was interrupted or when the embedding cache
+    # created it, so the cache itself keeps track of this.
+    if backend == 'pickle' or cache.is_migrated():
+        return cache
+
+    # One time migration of the old pickled cache, this way we do not have
+    # to query all the explanations from Wikipedia again
+    if os.path.isfile(legacy_path):
+        migrated = migrate_pickle_cache(legacy_path, cache)
+        print(
+            f'Migrated {migrated} explanations from {legacy_path} to {path}'
+        )
+    elif len(cache) == 0:
         print(
             f'Warning, no explanation cache was found at {path}\
             \nCreating a new one..'
         )
-        with open(path, 'wb') as f:
-            pickle.dump({}, f)
-        return {}
 
-    # Otherwise load the cache and return it
-    with open(path, 'rb') as f:
-        cache = pickle.load(f)
     return cache
 
 
-def load_wiki_lookup(path=Config.WIKI_LOOKUP_PICKLE):
+def load_embedding_cache(
+    path=Config.EXPLANATION_CACHE_DB,
+    model=Config.SPACY_MODEL,
+    max_size=Config.EMBEDDING_CACHE_SIZE,
+):
+    # The embeddings are stored in the same sqlite file as the
+    # explanations, a new table is created if it is not present
+    return EmbeddingCache(path, model, max_size)
+
+
+def load_wiki_lookup(
+    path=Config.WIKI_LOOKUP_TABLE,
+    legacy_path=Config.WIKI_LOOKUP_PICKLE,
+):
+    # The old pickled table is not used anymore, but it can be converted
+    # without reading the DBpedia dump again
+    if not os.path.isfile(path) and os.path.isfile(legacy_path):
+        raise FileNotFoundError(
+            f"Wiki lookup file not found at {path}, but there is an old \
+            one at {legacy_path}.\n Convert it with \
+            'python support/create_wiki_lookup_table.py --from-pickle'"
+        )
+
     # We need this file to get the correct titles
     if not os.path.isfile(path):
         raise FileNotFoundError(
@@ -57,11 +173,76 @@ def load_wiki_lookup(path=Config.WIKI_LOOKUP_PICKLE):
             This file can be created with *create_wiki_lookup_table.py*"
         )
 
-    with open(path, 'rb') as f:
-        lookup = pickle.load(f)
-    return lookup
-
-
-def extract_wiki_title(link):
-    return link.replace('<http://nl.wikipedia.org/wiki/', '') \
-               .replace('>', '')
+    # The table is memory mapped, so it is not loaded as a whole and all
+    # processes that use it share the same memory.
+    return FrozenTable(path)
+
+
+def resource_name(uri):
+    ''' Strips the DBpedia prefix from an uri, used in the lookup table '''
+    if uri.startswith(Config.DBPEDIA_RESOURCE_PREFIX):
+        return uri[len(Config.DBPEDIA_RESOURCE_PREFIX):]
+    return uri
+
+
+def create_http_session(
+    pool_size=10,
+    retries=Config.HTTP_RETRIES,
+    backoff=Config.HTTP_BACKOFF,
+    methods=('GET', 'POST'),
+):
+    '''
+    Creates a requests session with a connection pool of the given size
+    that retries failed requests with an exponential backoff. By default
+    urllib3 does not retry POST, but Spotlight is only posted to.
+    '''
+    settings = {
+        'total': retries,
+        'backoff_factor': backoff,
+        'status_forcelist': [429, 500, 502, 503, 504],
+    }
+
+    # Older versions of urllib3 call this 'method_whitelist'
+    try:
+        retry = Retry(**settings, allowed_methods=frozenset(methods))
+    except TypeError:
+        retry = Retry(**settings, method_whitelist=frozenset(methods))
+
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def clean_spotlight_resource(resource):
+    '''
+    Spotlight prefixes all keys with an '@' and returns every value as
+    a string. This strips the prefix and converts the numeric fields.
+    '''
+    numeric_fields = {
+        'support': int,
+        'offset': int,
+        'similarityScore': float,
+        'percentageOfSecondRank': float,
+    }
+
+    cleaned = {}
+
+    for key, value in resource.items():
+        key = key.lstrip('@')
+
+        if key in numeric_fields:
+            try:
+                value = numeric_fields[key](value)
+            except ValueError:
+                pass
+
+        cleaned[key] = value
+
+    return cleaned